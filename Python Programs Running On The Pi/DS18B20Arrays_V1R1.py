@@ -0,0 +1,170 @@
+#!/usr/bin/python
+
+"""
+Decodes many DS18B20 frames at once with NumPy.
+
+decode_frames() in DS18B20Frames_V1R1 is the right tool for the one frame
+set we get every measurement.  For replaying or backfilling a long run,
+thousands of frame sets, looping over every frame in Python is slow.  Here
+the raw bytes are viewed as an array with one record per frame, laid out
+exactly like the frame itself, and every temperature, resolution, alarm and
+CRC is worked out for all the frames in one pass of array operations.
+
+Needs NumPy, which the measurement programs themselves do not.
+"""
+
+import numpy
+from DS18B20Frames_V1R1 import crc_table, frame_length
+from TempConversion_V1R1 import raw_min, raw_max
+
+# One record per frame, the same 20 bytes as the frame
+frame_dtype = numpy.dtype([
+    ('sensors', 'u1'),          # byte 0: number of sensors in the run
+    ('temperature', '<i2'),     # bytes 1, 2: scratchpad temperature
+    ('upper_alarm', 'i1'),      # byte 3: TH, degrees C
+    ('lower_alarm', 'i1'),      # byte 4: TL, degrees C
+    ('configuration', 'u1'),    # byte 5: resolution
+    ('description', 'S12'),     # bytes 6 - 17: from the ATmega EEPROM
+    ('number', 'u1'),           # byte 18: sensor number
+    ('crc', 'u1'),              # byte 19
+])
+
+crc_lookup = numpy.frombuffer(bytes(crc_table), dtype = numpy.uint8)
+
+
+def make_fahrenheit_table():
+    """
+    Degrees F for every possible 16 bit scratchpad value, rounded with
+    Python's round() so the results match the results file exactly.
+    numpy.round() rounds halves differently.
+    """
+    table = numpy.empty(65536)
+    for raw in range(65536):
+        temp_c = raw
+        if raw > 32767:
+            temp_c -= 65536
+        table[raw] = round(1.8 * (temp_c / 16.0) + 32.0, 1)
+    return table
+
+fahrenheit_table = make_fahrenheit_table()
+
+
+def frame_array(data):
+    """
+    Views the raw bytes of any number of frames as an array of frame
+    records.  No bytes are copied.  Any partial frame at the end is left
+    out.
+    """
+    count = len(data) / frame_length
+    return numpy.frombuffer(buffer(data), dtype = frame_dtype,
+        count = count)
+
+
+def crc_ok(frames):
+    """
+    True for every frame whose CRC passes.  The CRC is run for all the
+    frames together, one byte position at a time.
+    """
+    raw = frames.view(numpy.uint8).reshape(len(frames), frame_length)
+    crc = numpy.zeros(len(frames), dtype = numpy.uint8)
+    for k in range(frame_length):
+        crc = crc_lookup[crc ^ raw[:, k]]
+    return crc == 0
+
+
+def decode_array(data):
+    """
+    Decodes the raw bytes of any number of frames.
+
+    Returns a dictionary of arrays, one element per frame:
+        number          sensor number
+        temperature_c   degrees C
+        temperature_f   degrees F, rounded to 0.1 like the results file
+        resolution      9 to 12 bits
+        alarm_high      temperature at or above the upper alarm
+        alarm_low       temperature at or below the lower alarm
+        crc_ok          the frame's CRC passes
+    """
+    frames = frame_array(data)
+    temperature_c = frames['temperature'] / 16.0
+
+    return {
+        'number': frames['number'],
+        'temperature_c': temperature_c,
+        'temperature_f': fahrenheit_table[
+            frames['temperature'].view(numpy.uint16)],
+        'resolution': (frames['configuration'] >> 5) + 9,
+        'alarm_high': temperature_c >= frames['upper_alarm'],
+        'alarm_low': temperature_c <= frames['lower_alarm'],
+        'crc_ok': crc_ok(frames),
+    }
+
+
+def convert_array(data, tables, unit = 'fahrenheit'):
+    """
+    Calibrated temperatures for the raw bytes of any number of frames.
+
+    tables is a dictionary of sensor number to that sensor's
+    ConversionTable from TempConversion_V1R1.  unit is 'celsius',
+    'fahrenheit' or 'kelvin'.  Each sensor's frames are converted with one
+    array lookup into its table.  Frames of sensors without a table come
+    out as NaN.  Raw values outside the DS18B20's range are clipped to it.
+    """
+    frames = frame_array(data)
+    index = numpy.clip(frames['temperature'], raw_min, raw_max) - raw_min
+    converted = numpy.empty(len(frames))
+    converted.fill(numpy.nan)
+    for number, table in tables.items():
+        select = frames['number'] == number
+        converted[select] = numpy.frombuffer(getattr(table, unit))[
+            index[select]]
+    return converted
+
+#---------------------------------------------------------------------
+
+# Test Code
+
+if __name__ == '__main__':
+
+    import time
+    from DS18B20Frames_V1R1 import build_frame, decode_frames, check_frames
+
+    # A day of one minute measurements from 12 sensors
+    frame_sets = 1440
+    sensors = 12
+    data = bytearray()
+    for i in range(frame_sets):
+        for number in range(sensors):
+            data += build_frame(sensors, number, -5.0 + 0.01 * i + number,
+                "Sensor %d" % number, 9 + number % 4, 25, 0)
+    data[20 * 100 + 7] ^= 0x01    # one bad frame
+
+    start = time.time()
+    values = decode_array(data)
+    array_time = time.time() - start
+
+    start = time.time()
+    temperature_f = []
+    for frame in decode_frames(data):
+        temperature_f.append(round(1.8 * (frame[1] / 16.0) + 32.0, 1))
+    good, bad = check_frames(data)
+    loop_time = time.time() - start
+
+    print "frames: ", len(values['number'])
+    print "arrays: %.1f ms, loops: %.1f ms" % (1000 * array_time,
+        1000 * loop_time)
+    print "same temperatures: ", list(values['temperature_f']) == temperature_f
+    print "bad CRCs: ", numpy.flatnonzero(~values['crc_ok'])
+    print "high alarms: %d, low alarms: %d" % (values['alarm_high'].sum(),
+        values['alarm_low'].sum())
+    print "resolutions: ", numpy.unique(values['resolution'])
+
+    from TempConversion_V1R1 import conversion_table
+    tables = {}
+    for number in range(sensors):
+        tables[number] = conversion_table(9 + number % 4,
+            number == 3 and (0.25, -0.375) or None)
+    start = time.time()
+    converted = convert_array(data, tables)
+    print "calibrated in %.1f ms, sensor 3 first reading %.1f F" % (
+        1000 * (time.time() - start), converted[3])
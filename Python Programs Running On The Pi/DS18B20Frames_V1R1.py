@@ -0,0 +1,320 @@
+#!/usr/bin/python
+
+"""
+Frames of DS18B20 data sent from the temperature enclosure.
+
+One frame is all the data for one sensor, 20 bytes:
+
+    byte 0: The number of sensors in the run
+    byte 1, and 2:  DS18B20 scratchpad data - the measured temperature
+    byte 3: DS18B20 scratchpad data - upper temperature alarm
+    byte 4: DS18B20 scratchpad data - lower temperature alarm
+    byte 5: DS18B20 scratchpad data - resolution
+    byte 6 through 17: from the ATmega328P EEPROM - device description
+    byte 18: from the ATmega328P EEPROM - sensor number
+    byte 19: CRC
+
+A frame set is one frame for every sensor, back to back.
+
+The CRC is the Dallas/Maxim CRC-8, polynomial X8 + X5 + X4 + 1, the same
+one the DS18B20 uses for its scratchpad.  Run over all 20 bytes of a good
+frame it comes out 0.
+
+The ESP8266 can send a frame set two ways.  The original way is every byte
+as decimal text followed by a comma.  The binary way is a 4 byte header,
+the characters "DS" and the length of the frame set as a 16 bit big endian
+number, followed by the raw frame bytes.  The Pi offers binary by sending
+binary_offer as soon as the ESP8266 connects.  Firmware that does not
+understand the offer ignores it and sends text.
+"""
+
+import struct
+
+frame_length = 20  # One frame is all the data for one device.
+
+binary_offer = "B"                    # Pi to ESP8266: binary is welcome
+binary_header = struct.Struct(">2sH") # "DS", length of the frame set
+binary_magic = "DS"
+
+# sensors, temperature, upper alarm, lower alarm, configuration,
+#   description, sensor number, CRC
+frame_struct = struct.Struct("<BhbbB12sBB")
+
+
+def make_crc_table():
+    """
+    CRC-8 of every possible byte, so crc8() does one lookup per byte
+    instead of eight shifts.
+    """
+    table = bytearray(256)
+    for i in range(256):
+        crc = i
+        for j in range(8):
+            if crc & 1:
+                crc = (crc >> 1) ^ 0x8C  # X8 + X5 + X4 + 1, bit reversed
+            else:
+                crc >>= 1
+        table[i] = crc
+    return table
+
+crc_table = make_crc_table()
+
+
+def crc8(data, start = 0, length = None):
+    """
+    Dallas/Maxim CRC-8 of length bytes of data starting at start.
+    """
+    if length is None:
+        length = len(data) - start
+    crc = 0
+    for byte in bytearray(data[start:start + length]):
+        crc = crc_table[crc ^ byte]
+    return crc
+
+
+def frame_ok(frame_set, j, frame_length = frame_length):
+    """
+    True if the CRC of frame j of the frame set passes.
+    """
+    return crc8(frame_set, frame_length * j, frame_length) == 0
+
+
+def check_frames(frame_set, frame_length = frame_length):
+    """
+    Checks the CRC of every frame of a frame set.
+
+    Returns (good, bad).  good is a dictionary of sensor number (byte 18)
+    to the frame, for every frame that passes.  bad is a list of the
+    sensor numbers of the frames that fail.  The sensor number of a bad
+    frame may itself be corrupted.
+    """
+    good = {}
+    bad = []
+    for j in range(len(frame_set) / frame_length):
+        frame = frame_set[frame_length * j:frame_length * (j + 1)]
+        if crc8(frame) == 0:
+            good[frame[18]] = frame
+        else:
+            bad.append(frame[18])
+    return good, bad
+
+
+class FrameAssembler(object):
+    """
+    Puts a frame set back together from what the ESP8266 sends, however it
+    happens to be split up by the network.  The first character tells us
+    whether it is text or binary.
+
+    Call feed() with every chunk as it arrives.  For text, only the digits
+    after the last comma of a chunk are carried over to the next one, every
+    complete field goes straight into a bytearray.  For binary, the header
+    gives the length and the bytes are copied straight into a bytearray of
+    that size.  As soon as we know how many frames to expect, complete() is
+    True the moment the last byte of the last frame is in, without waiting
+    for the ESP8266 to close the connection.  Call finish() when the
+    connection closes.
+
+    error is set if a field is not a byte, the length is not a whole number
+    of frames, or a frame disagrees about the number of sensors.
+    """
+
+    def __init__(self, frame_length = frame_length):
+        self.frame_length = frame_length
+        self.data = bytearray()
+        self.tail = ""        # text: digits of a field split between chunks
+                              # binary: header bytes received so far
+        self.binary = None    # None until the first character arrives
+        self.received = 0     # binary: bytes of the frame set received
+        self.sensors = 0      # from byte 0 of the first frame
+        self.expected = 0     # bytes in the whole frame set
+        self.error = False
+
+    def feed(self, chunk):
+        """
+        Adds one chunk.  Returns complete().
+        """
+        if self.error or self.complete() or not chunk:
+            return self.complete()
+
+        if self.binary is None:
+            self.binary = chunk[0] == binary_magic[0]
+
+        if self.binary:
+            self.add_binary(chunk)
+        else:
+            fields = (self.tail + chunk).split(",")
+            self.tail = fields.pop()
+            self.add_fields(fields)
+        return self.complete()
+
+    def add_binary(self, chunk):
+        if not self.expected:
+            self.tail += chunk
+            if len(self.tail) < binary_header.size:
+                return
+            magic, length = binary_header.unpack_from(self.tail)
+            chunk = self.tail[binary_header.size:]
+            self.tail = ""
+            if (magic != binary_magic or length == 0 or
+                    length % self.frame_length):
+                self.error = True
+                return
+            self.expected = length
+            self.data = bytearray(length)
+
+        count = min(len(chunk), self.expected - self.received)
+        self.data[self.received:self.received + count] = chunk[:count]
+        if not self.received and count:
+            self.sensors = self.data[0]
+        self.received += count
+
+        if self.received == self.expected:
+            if self.sensors * self.frame_length != self.expected:
+                self.error = True
+                return
+            for j in range(self.sensors):
+                if self.data[self.frame_length * j] != self.sensors:
+                    self.error = True
+                    return
+
+    def finish(self):
+        """
+        The connection has closed.  A last field without a trailing comma is
+        still good.  Returns complete().
+        """
+        if (not self.binary and self.tail.strip() and not self.error and
+                not self.complete()):
+            self.add_fields([self.tail])
+        self.tail = ""
+        return self.complete()
+
+    def add_fields(self, fields):
+        for field in fields:
+            try:
+                value = int(field)
+            except ValueError:
+                self.error = True
+                return
+            if value < 0 or value > 255:
+                self.error = True
+                return
+
+            position = len(self.data)
+            if position == 0:
+                if value == 0:
+                    self.error = True
+                    return
+                self.sensors = value
+                self.expected = value * self.frame_length
+            elif position % self.frame_length == 0 and value != self.sensors:
+                self.error = True   # frame disagrees about number of sensors
+                return
+
+            self.data.append(value)
+            if len(self.data) == self.expected:
+                return  # anything after the last frame is ignored
+
+    def complete(self):
+        if self.binary:
+            return (not self.error and self.expected > 0 and
+                self.received == self.expected)
+        return (not self.error and self.expected > 0 and
+            len(self.data) == self.expected)
+
+    def frame_set(self):
+        """
+        Returns the frame set as a bytearray, one element per byte.
+        """
+        return self.data
+
+
+def decode_frames(frame_set, frame_length = frame_length):
+    """
+    Unpacks every frame of a frame set without copying it.  The frame set
+    can be a bytearray, a string or anything else with the buffer
+    interface.
+
+    Returns a list with one tuple per frame: (sensors, temperature,
+    upper alarm, lower alarm, configuration, description, sensor number,
+    CRC).  The temperature is the signed 16 bit scratchpad value, in
+    sixteenths of a degree C.  The description is the raw 12 characters.
+    """
+    view = memoryview(frame_set)
+    return [frame_struct.unpack_from(view, frame_length * j)
+        for j in range(len(frame_set) / frame_length)]
+
+
+
+def build_frame(sensors, number, temperature, description = "",
+        resolution = 12, upper_alarm = 125, lower_alarm = -55):
+    """
+    Makes one frame the way the ATmega328P in the enclosure does.  The
+    opposite of decode_frames().
+
+    temperature is in degrees C.  It is rounded to the resolution, 9 to 12
+    bits, like the DS18B20 does.  A description shorter than 12 characters
+    ends with a line feed.  Returns the frame as a bytearray with the CRC in
+    byte 19.
+    """
+    step = 1 << (12 - resolution)   # sixteenths of a degree per count
+    raw = int(round(temperature * 16.0 / step)) * step
+    description = (description[:12] + "\n")[:12].ljust(12, " ")
+
+    frame = bytearray(frame_struct.pack(sensors, raw, upper_alarm,
+        lower_alarm, ((resolution - 9) << 5) | 0x1F, description, number, 0))
+    frame[19] = crc8(frame, 0, 19)
+    return frame
+
+#---------------------------------------------------------------------
+
+# Test Code
+
+if __name__ == '__main__':
+
+    # ROM code example from Maxim application note 27
+    print "CRC of 02 1C B8 01 00 00 00 is %02X, should be A2" % crc8(
+        bytearray([0x02, 0x1C, 0xB8, 0x01, 0x00, 0x00, 0x00]))
+
+    # 50 sensors, the most the ATmega328P EEPROM can hold, fed a few
+    # characters at a time
+    text = ""
+    for number in range(50):
+        frame = [50, 80, 1, 75, 70, 127]
+        frame += [ord(c) for c in "Test Sensor\n"] + [number]
+        frame.append(crc8(bytearray(frame)))
+        for byte in frame:
+            text += str(byte) + ","
+
+    assembler = FrameAssembler()
+    for i in range(0, len(text), 7):
+        if assembler.feed(text[i:i + 7]):
+            break
+    print "text length: ", len(text)
+    print "complete after %d characters: %s" % (i + 7, assembler.complete())
+    print "sensors: ", assembler.sensors
+    print "sensor numbers: ", [assembler.frame_set()[20 * j + 18]
+        for j in range(assembler.sensors)][:10], "..."
+
+    truncated = FrameAssembler()
+    truncated.feed(text[:1024])
+    print "first 1024 characters complete: ", truncated.finish()
+
+    # the same frame set in binary
+    binary = (binary_header.pack(binary_magic, len(assembler.frame_set())) +
+        str(assembler.frame_set()))
+    fromBinary = FrameAssembler()
+    for i in range(0, len(binary), 7):
+        fromBinary.feed(binary[i:i + 7])
+    print "binary length: ", len(binary)
+    print "binary matches text: ", (fromBinary.complete() and
+        fromBinary.frame_set() == assembler.frame_set())
+    print "first frame: ", decode_frames(fromBinary.frame_set())[0]
+
+    corrupted = bytearray(fromBinary.frame_set())
+    corrupted[20 * 7 + 1] ^= 0x10
+    good, bad = check_frames(corrupted)
+    print "good frames: %d, bad frames: %s" % (len(good), bad)
+
+    frame = build_frame(1, 5, -10.0625, "Freezer", resolution = 9)
+    print "built frame: ", decode_frames(frame)[0], "CRC ok: ", frame_ok(
+        frame, 0)
@@ -0,0 +1,501 @@
+#!/usr/bin/python
+
+"""
+A small web server on the Pi for looking at a run from any browser on the
+network: http://<the Pi's address>:8080/
+
+Anyone who can reach the Pi can look, so the programs start it only when
+DASHBOARD_PORT is set to a port number.
+
+    /                   the graph and the latest temperatures
+    /readings           the latest temperatures, as JSON
+    /history            a stretch of the stored temperatures, as JSON
+                            ?sensor=3&start=1439035200&end=1439038800
+                        all sensors if no sensor, the last hour if no start
+                        and end.  Every reading if the run keeps them,
+                        otherwise what the RRD files have.
+    /graph              a graph, as PNG
+                            ?window=day&theme=white&width=600&height=300
+                        window is run, hour, day or week, theme black or
+                        white.
+    /stream             every measurement as it is made, and every error,
+                        as server-sent events.  See ReadingStream_V1R1.
+
+Graphs are drawn only when a browser asks for one, from what is in the RRD
+files, one at a time.  Measurements waiting in memory to be written to them show up in the
+graph once they are, and in the readings at once.  Each graph is kept in a
+cache of the most recently used images, keyed by window, theme, size and
+the time of the newest measurement in the RRD files.  Until the files are
+written again the same image is served again without drawing it.
+Every image has an ETag and a Last-Modified time, so a browser that already
+has it gets a 304 Not Modified and nothing is sent at all, without waiting
+for a graph another browser is having drawn.  Before the
+first measurement is stored there is nothing to draw and /graph answers
+503 Service Unavailable.  A graph that cannot be drawn is a 500.
+
+The server runs in its own thread and needs nothing but Python.
+"""
+
+import BaseHTTPServer
+import SocketServer
+import cgi
+import hashlib
+import json
+import socket
+import threading
+import time
+import urlparse
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_tz, mktime_tz
+from ReadingStream_V1R1 import ReadingStream, server_sent_event
+from ReadingStore_V1R1 import CRC_OK
+
+class GraphError(Exception):
+    """
+    A graph could not be drawn.
+    """
+
+
+# Graph windows: name, seconds back from the newest measurement
+windows = OrderedDict([
+    ('run', None),
+    ('hour', 3600),
+    ('day', 86400),
+    ('week', 7 * 86400),
+])
+
+page = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<meta http-equiv="refresh" content="%(refresh)d">
+<title>%(title)s</title>
+<style>
+body { font-family: sans-serif; margin: 1em; }
+td { padding: 0.1em 1em 0.1em 0; }
+</style>
+</head>
+<body>
+<h2>%(title)s</h2>
+<p>%(links)s</p>
+%(graph)s
+<p>%(when)s</p>
+<table>
+%(rows)s
+</table>
+</body>
+</html>
+"""
+
+
+class DashboardHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    One request from a browser.
+    """
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        query = dict(urlparse.parse_qsl(url.query))
+        dashboard = self.server.dashboard
+        try:
+            if url.path == '/':
+                self.reply(dashboard.index(query), 'text/html; charset=utf-8')
+            elif url.path == '/readings':
+                self.reply(json.dumps(dashboard.latest), 'application/json')
+            elif url.path == '/history':
+                self.reply(json.dumps(dashboard.history(query)),
+                    'application/json')
+            elif url.path == '/graph':
+                try:
+                    self.graph(query)
+                except GraphError, e:
+                    self.send_error(500, str(e))
+            elif url.path == '/stream':
+                self.stream()
+            else:
+                self.send_error(404)
+        except ValueError, e:
+            self.send_error(400, str(e))
+
+    def graph(self, query):
+        dashboard = self.server.dashboard
+        graph = dashboard.graph_key(query)
+        if graph is None:
+            self.reply("No measurements yet\n", 'text/plain', [
+                ('Retry-After', str(dashboard.refresh))], 503)
+            return
+        key, etag, modified = graph
+        if self.headers.get('If-None-Match') == etag or \
+                self.not_modified_since(modified):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        png = dashboard.graph(key)
+        self.reply(png, 'image/png', [('ETag', etag), ('Cache-Control',
+            'no-cache'), ('Last-Modified', formatdate(modified,
+            usegmt = True))])
+
+    def stream(self):
+        """
+        Sends messages as they come until the listener goes away or is
+        dropped for being too slow.  A comment line every keepalive
+        seconds finds listeners that have gone.
+        """
+        dashboard = self.server.dashboard
+        listener = dashboard.stream.subscribe(dashboard.sensors_event())
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        try:
+            while True:
+                message = listener.next_message(dashboard.keepalive)
+                if message is None:
+                    if listener.dropped:
+                        break
+                    message = ": keepalive\n\n"
+                self.wfile.write(message)
+                self.wfile.flush()
+        except socket.error:
+            pass
+        finally:
+            dashboard.stream.unsubscribe(listener)
+
+    def not_modified_since(self, modified):
+        since = self.headers.get('If-Modified-Since')
+        if self.headers.get('If-None-Match') or not since:
+            return False
+        since = parsedate_tz(since)
+        return since is not None and mktime_tz(since) >= modified
+
+    def reply(self, body, content_type, headers = [], status = 200):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass    # keep the terminal for the measurements
+
+
+class DashboardHTTPServer(SocketServer.ThreadingMixIn,
+        BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class DashboardServer(threading.Thread):
+    """
+    Background thread serving the dashboard of one run.
+
+    Call start() once the RRD files and graph pipeline are set up,
+    update() after every good measurement and stop() at the end of the run.
+    Making one fails with socket.error if the port is in use.
+    """
+
+    def __init__(self, registry, store, pipeline, themes, readings = None,
+            host = '', port = 8080, refresh = 60, theme = 'black',
+            cache_size = 16, stream_queue = 32, keepalive = 15):
+        threading.Thread.__init__(self)
+        self.daemon = True    # do not keep the program alive on exit
+
+        self.registry = registry
+        self.store = store
+        self.pipeline = pipeline
+        self.themes = themes  # name -> ColorAttributes
+        self.readings = readings  # ReadingStore, or None to use the RRDs
+        self.refresh = refresh    # seconds between page reloads
+        self.theme = theme        # for the page if none is asked for
+        self.latest = {}
+        self.stream = ReadingStream(stream_queue)
+        self.keepalive = keepalive
+
+        self.lock = threading.Lock()    # for the cache
+        self.drawing = threading.Lock()     # one drawing at a time
+        self.cache = OrderedDict()  # key -> png, oldest used first
+        self.cache_size = cache_size
+        self.hits = 0
+        self.renders = 0
+        self.failed = 0
+
+        self.httpd = DashboardHTTPServer((host, port), DashboardHandler)
+        self.httpd.dashboard = self
+
+    def run(self):
+        self.httpd.serve_forever(poll_interval = 0.5)
+
+    def stop(self):
+        self.stream.close()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def update(self, timestamp, measurement, temp_f):
+        """
+        The temperature of each sensor, by slot, of the newest measurement.
+        """
+        self.latest = {'time': timestamp, 'measurement': measurement,
+            'sensors': [{'number': sensor.number,
+            'name': sensor.name.replace("\\:", ":"),
+            'temperature_f': round(temp_f[sensor.slot], 2)}
+            for sensor in self.registry]}
+        self.stream.publish(server_sent_event('reading', {'t': timestamp,
+            'm': measurement, 'f': [round(temp_f[sensor.slot], 2)
+            for sensor in self.registry]}, measurement))
+
+    def event(self, kind, number = None, timestamp = None):
+        """
+        Tells the stream's listeners a measurement went wrong.
+        """
+        if timestamp is None:
+            timestamp = int(time.time())
+        self.stream.publish(server_sent_event('error', {'t': timestamp,
+            'kind': kind, 'sensor': number}))
+
+    def sensors_event(self):
+        return server_sent_event('sensors', [{'number': sensor.number,
+            'name': sensor.name.replace("\\:", ":")}
+            for sensor in self.registry])
+
+    def history(self, query):
+        """
+        {sensor number: [[time, degrees F], ...]} from start to end.
+        """
+        end = int(query.get('end', self.latest.get('time') or time.time()))
+        start = int(query.get('start', end - 3600))
+        sensors = list(self.registry)
+        if 'sensor' in query:
+            sensor = self.registry.lookup(int(query['sensor']))
+            if not sensor:
+                raise ValueError("no sensor %s" % query['sensor'])
+            sensors = [sensor]
+
+        result = dict((str(sensor.number), []) for sensor in sensors)
+        if self.readings:
+            values = self.readings.readings(start, end, ['time', 'number',
+                'temperature', 'flags'])
+            for t, number, raw, flags in zip(values['time'], values['number'],
+                    values['temperature'], values['flags']):
+                if flags & CRC_OK and str(number) in result:
+                    result[str(number)].append([t, round(
+                        self.registry.lookup(number).conversion.to_fahrenheit(
+                        raw), 2)])
+        else:
+            for sensor in sensors:
+                result[str(sensor.number)] = [[t, value] for t, value in
+                    self.store.fetch(sensor, start, end)]
+        return result
+
+    def graph_key(self, query):
+        """
+        (cache key, ETag, Last-Modified time) of the graph asked for, None
+        if no measurement has been stored yet.  Draws nothing, so a browser
+        that has the graph already is answered at once.
+        """
+        window = query.get('window', 'run')
+        theme = query.get('theme', self.theme)
+        width = min(max(int(query.get('width', self.pipeline.width)), 200),
+            2000)
+        height = min(max(int(query.get('height', self.pipeline.height)),
+            100), 1200)
+        if window not in windows:
+            raise ValueError("window is one of " + ", ".join(windows))
+        if theme not in self.themes:
+            raise ValueError("theme is one of " + ", ".join(
+                sorted(self.themes)))
+
+        written = self.store.written
+        if written is None:
+            return None
+        key = (window, theme, width, height, written)
+        return key, '"%s"' % hashlib.md5(repr(key)).hexdigest()[:16], written
+
+    def graph(self, key):
+        """
+        PNG of the graph with this key, from the cache if it is there.
+        Raises GraphError if it cannot be drawn.
+        """
+        png = self.cached(key)
+        if png is not None:
+            return png
+        self.drawing.acquire()
+        try:
+            png = self.cached(key)  # drawn while this one waited
+            if png is not None:
+                return png
+            window, theme, width, height, written = key
+            self.renders += 1
+            try:
+                png = self.pipeline.render(written, windows[window],
+                    self.themes[theme], width, height)
+            except Exception, e:
+                self.failed += 1
+                raise GraphError("Could not draw the graph: %s" % e)
+            self.lock.acquire()
+            try:
+                self.cache[key] = png
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last = False)
+            finally:
+                self.lock.release()
+        finally:
+            self.drawing.release()
+        return png
+
+    def cached(self, key):
+        """
+        The PNG with this key if it is in the cache, now the most recently
+        used, otherwise None.
+        """
+        self.lock.acquire()
+        try:
+            png = self.cache.pop(key, None)
+            if png is not None:
+                self.hits += 1
+                self.cache[key] = png
+            return png
+        finally:
+            self.lock.release()
+
+    def index(self, query):
+        window = query.get('window', 'run')
+        theme = query.get('theme', self.theme)
+        if window not in windows or theme not in self.themes:
+            raise ValueError("no such graph")
+
+        links = []
+        for name in windows:
+            links.append('<a href="/?window=%s&amp;theme=%s">%s</a>' % (
+                name, theme, name))
+        for name in sorted(self.themes):
+            links.append('<a href="/?window=%s&amp;theme=%s">%s</a>' % (
+                window, name, name))
+
+        rows = []
+        graph = ""
+        when = "No measurements yet"
+        if self.latest:
+            graph = ('<img src="/graph?window=%s&amp;theme=%s" alt="graph">'
+                % (window, theme))
+            when = "Measurement %d, %s" % (self.latest['measurement'],
+                time.strftime("%A, %B %d, %I:%M:%S %p",
+                time.localtime(self.latest['time'])))
+            for sensor in self.latest['sensors']:
+                rows.append("<tr><td>%s</td><td>%3.1f &deg;F</td></tr>" % (
+                    cgi.escape(sensor['name']), sensor['temperature_f']))
+
+        return page % {'refresh': self.refresh,
+            'title': cgi.escape(self.pipeline.title.replace("\\", "")),
+            'links': " | ".join(links), 'graph': graph, 'when': when,
+            'rows': "\n".join(rows)}
+
+#---------------------------------------------------------------------
+
+# Test Code
+
+if __name__ == '__main__':
+
+    import httplib
+    import urllib2
+    from SensorRegistry_V1R1 import SensorRegistry
+    from TempConversion_V1R1 import conversion_table
+
+    class Pipeline(object):
+        """
+        Stands in for the GraphPipeline, so the test needs no rrdtool.
+        """
+        title = "Test\\ Title"
+        start = 1439035200
+        width = 600
+        height = 300
+        def render(self, end, seconds, color, width, height):
+            if width == 999:
+                raise ValueError("rrdtool says no")
+            time.sleep(0.2)
+            return "PNG %s %s %s %dx%d" % (end, seconds, color, width, height)
+
+    class Store(object):
+        written = None          # nothing in the RRD files yet
+
+    registry = SensorRegistry()
+    for number in [3, 8]:
+        sensor = registry.add(number, "Box\\: %d" % number, 12)
+        sensor.conversion = conversion_table(12)
+
+    store = Store()
+    dashboard = DashboardServer(registry, store, Pipeline(),
+        {'black': 'black', 'white': 'white'}, port = 8089, cache_size = 2)
+    dashboard.start()
+    base = "http://localhost:8089"
+    try:
+        urllib2.urlopen(base + "/graph")
+    except urllib2.HTTPError, e:
+        print "before the first measurement: %d, retry after %s s" % (e.code,
+            e.info()['Retry-After'])
+
+    dashboard.update(1439038800, 60, [71.25, 68.5])
+    store.written = 1439038800
+
+    print "readings: ", urllib2.urlopen(base + "/readings").read()
+    print "page: %d bytes" % len(urllib2.urlopen(base + "/").read())
+
+    for url in ["/graph?window=day", "/graph?window=day", "/graph?window=week",
+            "/graph?window=hour", "/graph?window=day"]:
+        begin = time.time()
+        reply = urllib2.urlopen(base + url)
+        print "%-20s %s in %.0f ms" % (url, reply.read(), 1000 *
+            (time.time() - begin))
+    print "renders: %d, from the cache: %d" % (dashboard.renders,
+        dashboard.hits)
+
+    etag = reply.info()['ETag']
+    for header, value in [('If-None-Match', etag), ('If-Modified-Since',
+            reply.info()['Last-Modified'])]:
+        try:
+            urllib2.urlopen(urllib2.Request(base + "/graph?window=day",
+                headers = {header: value}))
+        except urllib2.HTTPError, e:
+            print "%s: %d" % (header, e.code)
+
+    store.written += 60     # a new measurement in the RRD files
+    try:
+        reply = urllib2.urlopen(urllib2.Request(base + "/graph?window=day",
+            headers = {'If-None-Match': etag}))
+        print "after a new measurement: ", reply.read()
+        etag = reply.info()['ETag']
+    except urllib2.HTTPError, e:
+        print "after a new measurement: %d" % e.code
+
+    # A browser with the graph is not kept waiting by one being drawn
+    slow = threading.Thread(target = urllib2.urlopen,
+        args = (base + "/graph?window=week&width=800",))
+    slow.start()
+    time.sleep(0.05)
+    begin = time.time()
+    try:
+        urllib2.urlopen(urllib2.Request(base + "/graph?window=day",
+            headers = {'If-None-Match': etag}))
+    except urllib2.HTTPError, e:
+        print "while drawing another: %d in %.0f ms" % (e.code, 1000 *
+            (time.time() - begin))
+    slow.join()
+
+    for url in ["/graph?window=year", "/graph?width=999"]:
+        try:
+            urllib2.urlopen(base + url)
+        except urllib2.HTTPError, e:
+            print "%s: %d" % (url, e.code)
+
+    # A wall display follows the stream
+    connection = httplib.HTTPConnection("localhost", 8089)
+    connection.request("GET", "/stream")
+    display = connection.getresponse()
+    print "stream: ", display.getheader('Content-Type')
+    dashboard.update(1439038860, 61, [71.3, 68.4])
+    dashboard.event('crc', 8, 1439038920)
+    for i in range(10):
+        print display.fp.readline(),
+    dashboard.stop()
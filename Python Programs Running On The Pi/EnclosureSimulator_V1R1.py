@@ -0,0 +1,233 @@
+#!/usr/bin/python
+
+"""
+Stands in for a temperature enclosure so the Pi programs can be tested and
+timed without the hardware.
+
+It makes correctly formatted 20 byte frames: sensor numbers, descriptions,
+resolution and a good CRC, with temperatures that drift slowly up and down.
+
+In WiFi mode it acts as the ESP8266.  It connects to the Pi on port 50007
+at the push rate and sends the frame set, in binary if the Pi offers it and
+--binary is given, otherwise as comma separated text.  Several enclosures
+can be simulated at once, each connecting from its own loopback address.
+
+In serial mode it acts as the Gertboard.  It opens a pseudo terminal pair
+and prints the name of the slave side.  Point SERIAL_PORT in
+GraphRemoteTemperature_RF_V1R1.py at that name.  Every "s" it receives is
+answered with the frame set.
+
+Packet loss, corruption and reordering can be added to see how the Pi
+programs cope.  Hit CTRL C to stop; the number of pushes or replies and
+how long they took is printed.
+
+    python EnclosureSimulator_V1R1.py wifi --sensors 50 --rate 2
+    python EnclosureSimulator_V1R1.py serial --sensors 8 --corrupt 0.1
+"""
+
+import argparse
+import math
+import os
+import pty
+import random
+import socket
+import threading
+import time
+import tty
+from DS18B20Frames_V1R1 import build_frame, binary_offer, binary_header
+from DS18B20Frames_V1R1 import binary_magic
+
+max_sensors = 50    # the most the enclosure's sketch and EEPROM allow
+
+
+class Enclosure(object):
+    """
+    The sensors in one enclosure and the faults to put in their data.
+    """
+
+    def __init__(self, sensors, resolution = 12, loss = 0.0, corrupt = 0.0,
+            reorder = 0.0, first_number = 1):
+        self.sensors = sensors
+        self.resolution = resolution
+        self.loss = loss          # fraction of frame sets not sent
+        self.corrupt = corrupt    # fraction of frame sets with one bad bit
+        self.reorder = reorder    # fraction of frame sets in shuffled order
+        self.numbers = range(first_number, first_number + sensors)
+        self.started = time.time()
+
+        self.sent = 0
+        self.lost = 0
+        self.corrupted = 0
+        self.reordered = 0
+
+    def temperature(self, i):
+        """
+        Each sensor sits at its own temperature and swings a couple of
+        degrees over a few minutes.
+        """
+        elapsed = time.time() - self.started
+        return 20.0 + i + 2.0 * math.sin(elapsed / (60.0 + 10.0 * i))
+
+    def frame_set(self):
+        """
+        Returns the next frame set as a bytearray, or None if it is lost.
+        """
+        if random.random() < self.loss:
+            self.lost += 1
+            return None
+
+        frames = []
+        for i, number in enumerate(self.numbers):
+            frames.append(build_frame(self.sensors, number,
+                self.temperature(i), "Sim Sensor%d" % number,
+                self.resolution))
+
+        if random.random() < self.reorder:
+            random.shuffle(frames)
+            self.reordered += 1
+
+        frame_set = bytearray().join(frames)
+        if random.random() < self.corrupt:
+            bit = random.randrange(8 * len(frame_set))
+            frame_set[bit / 8] ^= 1 << (bit % 8)
+            self.corrupted += 1
+
+        self.sent += 1
+        return frame_set
+
+
+def text_frames(frame_set):
+    """
+    Every byte in decimal followed by a comma, like the ESP8266 sends.
+    """
+    return "".join(["%d," % byte for byte in frame_set])
+
+
+def run_wifi(enclosure, host, port, rate, binary, source, timings):
+    """
+    Pushes a frame set to the Pi every 1 / rate seconds, like the ESP8266.
+    """
+    next_push = time.time()
+    while True:
+        next_push += 1.0 / rate
+        frame_set = enclosure.frame_set()
+
+        if frame_set is not None:
+            start = time.time()
+            c = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            try:
+                if source:
+                    c.bind((source, 0))
+                c.connect((host, port))
+
+                offered = False
+                if binary:
+                    c.settimeout(0.2)   # same wait as the ESP8266 firmware
+                    try:
+                        offered = c.recv(1) == binary_offer
+                    except socket.timeout:
+                        pass
+
+                if offered:
+                    c.sendall(binary_header.pack(binary_magic,
+                        len(frame_set)) + str(frame_set))
+                else:
+                    c.sendall(text_frames(frame_set))
+                timings.append(time.time() - start)
+            except socket.error:
+                timings.append(None)   # Pi not requesting data
+            c.close()
+
+        time.sleep(max(0, next_push - time.time()))
+
+
+def run_serial(enclosure, timings):
+    """
+    Answers every "s" on the pseudo terminal with the frame set, like the
+    Gertboard.
+    """
+    master, slave = pty.openpty()
+    tty.setraw(slave)
+    print "Serial port for the Pi program: ", os.ttyname(slave)
+
+    while True:
+        request = os.read(master, 1)
+        if request != "s":
+            continue
+        start = time.time()
+        frame_set = enclosure.frame_set()
+        if frame_set is not None:
+            os.write(master, str(frame_set))
+            timings.append(time.time() - start)
+
+
+def report(enclosures, timings):
+    sent = sum([e.sent for e in enclosures])
+    print
+    print "Frame sets sent: %d" % sent
+    print "Lost: %d, Corrupted: %d, Reordered: %d" % (
+        sum([e.lost for e in enclosures]),
+        sum([e.corrupted for e in enclosures]),
+        sum([e.reordered for e in enclosures]))
+
+    failed = len([t for t in timings if t is None])
+    done = sorted([t for t in timings if t is not None])
+    if failed:
+        print "Pi not requesting data: %d" % failed
+    if done:
+        print ("Time to deliver a frame set: median %.2f ms, "
+            "95%% %.2f ms, worst %.2f ms" % (1000 * done[len(done) / 2],
+            1000 * done[int(0.95 * (len(done) - 1))], 1000 * done[-1]))
+
+# ----------------------------------------------------------------------------
+
+# Main Program
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description = "Simulates a DS18B20 temperature enclosure")
+    parser.add_argument("mode", choices = ["wifi", "serial"])
+    parser.add_argument("--sensors", type = int, default = 4)
+    parser.add_argument("--resolution", type = int, default = 12,
+        choices = [9, 10, 11, 12])
+    parser.add_argument("--enclosures", type = int, default = 1,
+        help = "WiFi only, each connects from its own 127.0.0.x address")
+    parser.add_argument("--host", default = "127.0.0.1")
+    parser.add_argument("--port", type = int, default = 50007)
+    parser.add_argument("--rate", type = float, default = 0.2,
+        help = "WiFi pushes per second per enclosure")
+    parser.add_argument("--binary", action = "store_true",
+        help = "send binary frames if the Pi offers them")
+    parser.add_argument("--loss", type = float, default = 0.0)
+    parser.add_argument("--corrupt", type = float, default = 0.0)
+    parser.add_argument("--reorder", type = float, default = 0.0)
+    args = parser.parse_args()
+
+    if args.sensors < 1 or args.sensors > max_sensors:
+        parser.error("--sensors must be 1 to %d" % max_sensors)
+
+    enclosures = []
+    timings = []
+    for i in range(args.enclosures if args.mode == "wifi" else 1):
+        enclosures.append(Enclosure(args.sensors, args.resolution,
+            args.loss, args.corrupt, args.reorder))
+
+    try:
+        if args.mode == "serial":
+            run_serial(enclosures[0], timings)
+        else:
+            for i, enclosure in enumerate(enclosures):
+                source = None
+                if args.enclosures > 1 and args.host.startswith("127."):
+                    source = "127.0.0.%d" % (i + 2)
+                worker = threading.Thread(target = run_wifi, args = (
+                    enclosure, args.host, args.port, args.rate, args.binary,
+                    source, timings))
+                worker.daemon = True
+                worker.start()
+            while True:
+                time.sleep(1)
+
+    except(KeyboardInterrupt):
+        report(enclosures, timings)
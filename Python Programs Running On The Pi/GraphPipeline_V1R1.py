@@ -0,0 +1,396 @@
+#!/usr/bin/python
+
+"""
+Draws every graph of a run, in every background and for every stretch of
+time, from one read of the RRD files.
+
+Each rrdtool graph reads the RRD files again for its DEFs.  The black and
+white graphs read everything twice, and graphs of the last hour, day and
+week as well would read it six times.  Here the temperatures are fetched
+once for each archive the graphs need, and every image is drawn from that
+data in memory.  Images that read the same archive share one fetch, so the
+work grows with the number of images and not with images times sensors
+times reads.
+
+Only matplotlib can draw from data in memory, so the one read is only done
+when a program calls choose_plotter('matplotlib') (sudo apt-get install
+python-matplotlib).  Then the images are drawn from it on every core of the
+Pi at once.  By default, or if matplotlib will not import, the images are
+drawn by rrdtool as they always have been, and each image reads every RRD
+file itself.  fetches counts the reads either way.  The worker processes
+are started by choose_plotter(), which a program calls before it starts any
+thread of its own.
+
+windows are (file name suffix, seconds back from the last measurement),
+None for the whole run.  themes are (file name suffix, ColorAttributes).
+The image of the whole run in a theme keeps the file name the programs
+have always used, filename_black.png or filename_white.png.
+"""
+
+import multiprocessing
+import signal
+import tempfile
+import threading
+from cStringIO import StringIO
+from datetime import datetime
+from pyrrd.graph import Graph, COMMENT
+from TemperatureRRD_V1R1 import rrd_backend
+
+pyplot = None   # until choose_plotter('matplotlib')
+dates = None
+pool = None     # worker processes drawing with matplotlib
+
+# The graphs the programs draw if not told otherwise: the whole run
+whole_run = [('', None)]
+
+# For programs that want more.  Suffix, seconds
+hour_day_week = [
+    ('', None),
+    ('_hour', 3600),
+    ('_day', 86400),
+    ('_week', 7 * 86400),
+]
+
+
+def choose_plotter(plotter, processes = None):
+    """
+    Draws the graphs with plotter, 'rrdtool' or 'matplotlib'.  For
+    matplotlib a worker process is started for each core, or processes.
+    Call before starting any thread, so none is copied into the workers
+    half way through something, and before making a GraphPipeline.
+    Returns the name of the one that will be used.
+    """
+    global pyplot, dates, pool
+    pyplot = None
+    if plotter == 'matplotlib':
+        try:
+            import matplotlib
+            matplotlib.use('Agg')     # no display needed
+            from matplotlib import pyplot, dates
+        except ImportError:
+            print "\nNo matplotlib, graphing with rrdtool\n"
+            return "rrdtool"
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        if processes > 1 and not pool:
+            pool = multiprocessing.Pool(processes, quiet_worker)
+        return "matplotlib %s" % matplotlib.__version__
+    return "rrdtool"
+
+
+def theme_colors(color):
+    """
+    The colors of a pyrrd ColorAttributes, as a dictionary that can be
+    sent to another process.
+    """
+    return dict((name, getattr(color, name)) for name in ['back', 'canvas',
+        'mgrid', 'axis', 'frame', 'font'])
+
+
+def plot(job):
+    """
+    Draws one image with matplotlib.  Called in a worker process, so job
+    is plain data: file name, colors, title, comment, width and height in
+    pixels, and the (legend, color, times, temperatures) of each sensor.
+    The file name may be a file object instead.
+    """
+    filename, colors, title, comment, width, height, series = job
+    dpi = 100.0
+    figure = pyplot.figure(figsize = ((width + 100) / dpi,
+        (height + 100 + 10 * len(series)) / dpi), dpi = dpi,
+        facecolor = colors['back'])
+    try:
+        axes = figure.add_subplot(1, 1, 1)
+        if hasattr(axes, 'set_facecolor'):
+            axes.set_facecolor(colors['canvas'])
+        else:
+            axes.set_axis_bgcolor(colors['canvas'])     # matplotlib 1.x
+        for legend, color, times, values in series:
+            axes.plot([datetime.fromtimestamp(t) for t in times],
+                [float('nan') if value is None else value
+                for value in values], color = color, label = legend,
+                linewidth = 1)
+        if comment:         # below the legends, as rrdtool puts it
+            axes.plot([], [], ' ', label = comment)
+
+        axes.set_title(title, color = colors['font'])
+        axes.set_ylabel('Degrees F', color = colors['font'])
+        axes.grid(True, color = colors['mgrid'], linestyle = ':')
+        axes.tick_params(colors = colors['axis'], labelcolor = colors['font'],
+            labelsize = 'small')
+        for spine in axes.spines.values():
+            spine.set_color(colors['frame'])
+        # the same on every matplotlib, short enough to clear the legends
+        shown = [t for legend, color, times, values in series for t in times]
+        if shown:
+            axes.xaxis.set_major_formatter(dates.DateFormatter('%H:%M'
+                if max(shown) - min(shown) <= 86400 else '%b %d %H:%M'))
+        figure.autofmt_xdate()
+
+        legend = axes.legend(loc = 'upper center', ncol = 2, frameon = False,
+            fontsize = 'small', bbox_to_anchor = (0.5, -0.2))
+        for text in legend.get_texts():
+            text.set_color(colors['font'])
+
+        figure.savefig(filename, dpi = dpi, facecolor = colors['back'],
+            bbox_inches = 'tight')
+    finally:
+        pyplot.close(figure)
+
+
+def quiet_worker():
+    """
+    Workers leave CTRL C and shutdown signals to the program.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGHUP, signal.SIG_DFL)
+
+
+class GraphPipeline(object):
+    """
+    The graphs of one run.  Draw them all with draw(end).
+    """
+
+    def __init__(self, filename, store, registry, start, title, comment,
+            height, themes, windows = whole_run, width = 600):
+        self.store = store
+        self.registry = registry
+        self.start = start
+        self.title = title
+        self.comment = comment
+        self.width = width
+        self.height = height
+        self.themes = themes
+        self.windows = windows
+        self.graph_comment = comment and COMMENT(comment)
+
+        self.images = []      # (file, ColorAttributes, window, seconds)
+        for theme, color in themes:
+            for window, seconds in windows:
+                self.images.append((filename + theme + window + '.png',
+                    color, window, seconds))
+        self.fetches = 0      # RRD reads, all draws
+        self.drawn = 0        # images, all draws
+        self.lock = threading.Lock()  # matplotlib draws one at a time
+
+    def window_start(self, seconds, end):
+        if seconds is None:
+            return self.start
+        return max(self.start, end - seconds)
+
+    def fetch(self, end):
+        """
+        The temperatures each image needs: for every window, its archive
+        and a dictionary of data source name to (time, temperature) pairs.
+        Each RRD file is read once for every archive, from the earliest
+        time any window wants from it.
+        """
+        archives = {}         # window -> (cf, seconds)
+        earliest = {}         # (cf, seconds) -> start
+        for window, seconds in self.windows:
+            start = self.window_start(seconds, end)
+            archive = self.store.archive(start, end, self.width)
+            archives[window] = archive
+            earliest[archive] = min(earliest.get(archive, start), start)
+
+        fetched = {}          # (cf, seconds) -> {ds_name: [(time, value)]}
+        for archive, start in earliest.items():
+            fetched[archive] = self.read(archive, start, end)
+
+        dataset = {}
+        for window, seconds in self.windows:
+            start = self.window_start(seconds, end)
+            data = fetched[archives[window]]
+            dataset[window] = dict((name, [(t, value) for t, value in points
+                if start <= t <= end]) for name, points in data.items())
+        return dataset
+
+    def read(self, archive, start, end):
+        """
+        Every sensor's temperatures in one archive, one fetch per RRD file.
+        """
+        cf, seconds = archive
+        data = {}
+        for device in self.store.devices:
+            data.update(device.fetch(cf = cf, resolution = seconds,
+                start = start, end = end))
+            self.fetches += 1
+        return data
+
+    def job(self, image, color, data, width, height):
+        """
+        What plot() needs to draw one image from data, a dictionary of data
+        source name to (time, temperature) pairs.
+        """
+        series = []
+        for sensor in self.registry:
+            points = data.get(sensor.ds_name, [])
+            values = [value for t, value in points if value is not None]
+            name = sensor.name.replace("\\:", ":")
+            legend = "%s Temperature" % name
+            if values:
+                legend += ", Average %6.2f Degrees F" % (sum(values) /
+                    len(values))
+            series.append((legend, sensor.color,
+                [t for t, value in points], [value for t, value in points]))
+        return (image, theme_colors(color), self.title.replace("\\", ""),
+            self.comment, width, height, series)
+
+    def draw(self, end):
+        """
+        Draws every image from the start of its window to end.
+        """
+        if not pyplot:
+            for image, color, window, seconds in self.images:
+                self.graph(image, color, self.window_start(seconds, end), end,
+                    self.width, self.height)
+            return
+        dataset = self.fetch(end)
+        jobs = [self.job(image, color, dataset[window], self.width,
+            self.height) for image, color, window, seconds in self.images]
+        self.drawn += len(jobs)
+        if pool:
+            pool.map(plot, jobs)
+        else:
+            self.lock.acquire()
+            try:
+                for job in jobs:
+                    plot(job)
+            finally:
+                self.lock.release()
+
+    def render(self, end, seconds, color, width = None, height = None):
+        """
+        One image, of the seconds before end or the whole run if seconds is
+        None, as PNG data.  For drawing graphs only when someone asks.
+        """
+        width = width or self.width
+        height = height or self.height
+        start = self.window_start(seconds, end)
+        if not pyplot:
+            image = tempfile.NamedTemporaryFile(suffix = '.png')
+            try:
+                self.graph(image.name, color, start, end, width, height)
+                return open(image.name, 'rb').read()
+            finally:
+                image.close()
+
+        data = self.read(self.store.archive(start, end, width), start, end)
+        self.drawn += 1
+        png = StringIO()
+        self.lock.acquire()
+        try:
+            plot(self.job(png, color, data, width, height))
+        finally:
+            self.lock.release()
+        return png.getvalue()
+
+    def graph(self, image, color, start, end, width, height):
+        """
+        Without matplotlib every image is an rrdtool graph, reading the
+        coarsest archive with a point for every pixel.  rrdtool reads each
+        RRD file once for all the sensors in it.
+        """
+        cf, step = self.store.archive(start, end, width)
+        graph = Graph(image, start = start, end = end, color = color,
+            vertical_label = 'Degrees\ F', width = width, height = height,
+            title = self.title, backend = rrd_backend)
+        self.lock.acquire()     # the DEFs are shared by every graph
+        try:
+            for sensor in self.registry:
+                sensor.graph_def.cdef = cf
+                sensor.graph_def.step = step
+                graph.data.extend([sensor.graph_def, sensor.graph_line,
+                    sensor.graph_aver, sensor.graph_val])
+            if self.graph_comment:
+                graph.data.append(self.graph_comment)
+            graph.write()
+            self.fetches += len(self.store.devices)
+            self.drawn += 1
+        finally:
+            self.lock.release()
+
+    def summary(self):
+        """
+        Lines for the terminal at the end of the run.
+        """
+        return ["Graph Images: %d, RRD Reads For Them: %d (%s)" % (
+            self.drawn, self.fetches, pyplot and "matplotlib" or "rrdtool")]
+
+    def close(self):
+        """
+        Stops the worker processes.  Call at the end of the run.
+        """
+        global pool
+        if pool:
+            pool.close()
+            pool.join()
+            pool = None
+
+#---------------------------------------------------------------------
+
+# Test Code
+
+if __name__ == '__main__':
+
+    print "drawing with", choose_plotter('matplotlib')
+
+    import os
+    import time
+    from pyrrd.graph import ColorAttributes
+    from SensorRegistry_V1R1 import SensorRegistry
+    from TemperatureRRD_V1R1 import TemperatureStore
+
+    class MemoryRRD(object):
+        """
+        Stands in for the RRD file of a week of measurements, so the test
+        needs no rrdtool.
+        """
+        def __init__(self, names, start):
+            self.names = names
+            self.start = start
+        def fetch(self, cf, resolution, start, end):
+            step = resolution or 60
+            first = max(start, self.start) / step * step
+            return dict((name, [(t, 68.0 + i + (t / step) % 10 * 0.1)
+                for t in range(first, end + 1, step)])
+                for i, name in enumerate(self.names))
+
+    registry = SensorRegistry()
+    for number in range(1, 5):
+        registry.add(number, "Box\\: %d" % number, 12)
+
+    black = ColorAttributes()
+    white = ColorAttributes()
+    for color, shades in [(black, ['#000000', '#333333', '#CCCCCC',
+            '#FFFFFF', '#0000AA', '#FFFFFF']), (white, ['#FFFFFF', '#EEEEEE',
+            '#444444', '#000000', '#0000AA', '#000000'])]:
+        for name, shade in zip(['back', 'canvas', 'mgrid', 'axis', 'frame',
+                'font'], shades):
+            setattr(color, name, shade)
+
+    start = 1439035200
+    end = start + 7 * 86400
+    store = TemperatureStore("test", registry, 60, 7 * 1440, start)
+    store.devices = [MemoryRRD([sensor.ds_name for sensor in registry],
+        start)]
+    folder = tempfile.mkdtemp()
+    pipeline = GraphPipeline(os.path.join(folder, "test"), store, registry,
+        start, "Test\\ Title", "a comment", 300, [('_black', black),
+        ('_white', white)], hour_day_week)
+
+    dataset = pipeline.fetch(end)
+    for window, seconds in hour_day_week:
+        print "window %-6s points per sensor: %d" % (window or 'run',
+            len(dataset[window][registry[0].ds_name]))
+    if pyplot:
+        pipeline.fetches = 0
+        begin = time.time()
+        pipeline.draw(end)
+        print "drew %d images in %.2f s" % (len(pipeline.images),
+            time.time() - begin)
+        for line in pipeline.summary():
+            print line
+        print sorted(os.listdir(folder))
+    pipeline.close()
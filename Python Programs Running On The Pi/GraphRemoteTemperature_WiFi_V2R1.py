@@ -1,7 +1,7 @@
 #!/usr/bin/python
 
 """
-Graphs temperature results from up to 12 sensors. Sensors are connected to box
+Graphs temperature results from up to 50 sensors. Sensors are connected to box
 which is controlled by an ATmega328P.
 
 In this version, the box communicates with the Pi over WiFi.  There is a
@@ -12,27 +12,59 @@ Description of this program is on my blog.
 MJL - www.thepiandi.blogspot.com - 07/27/2015
 """
 
+import argparse
 import os
 from datetime import datetime
 import time
+import signal
+import socket
 import subprocess
 import sys
 from GUI4GraphTemperature_V2R2 import *
-from pyrrd.rrd import DataSource, RRA, RRD
 from pyrrd.graph import DEF, CDEF, VDEF, LINE, AREA, GPRINT, COMMENT
 from pyrrd.graph import ColorAttributes
 from pyrrd.graph import Graph
-import socket
+from WiFiListener_V1R1 import WiFiListener
+from DS18B20Frames_V1R1 import decode_frames, check_frames, frame_ok
+from SensorRegistry_V1R1 import SensorRegistry
+from TempConversion_V1R1 import load_calibration, conversion_table
+from TemperatureRRD_V1R1 import TemperatureStore, rrd_backend, backend_name
+from GraphRenderer_V1R1 import GraphRenderer
+from GraphPipeline_V1R1 import GraphPipeline, whole_run, hour_day_week
+from GraphPipeline_V1R1 import choose_plotter
+from DashboardServer_V1R1 import DashboardServer
+from MeasurementScheduler_V1R1 import MeasurementScheduler, clock_name
+from MeasurementScheduler_V1R1 import LatencyEstimate
+from RetryPolicy_V1R1 import RetryPolicy
+from ResultsWriter_V1R1 import ResultsWriter
+from ReadingStore_V1R1 import ReadingStore
+from TemperatureDatabase_V1R1 import TemperatureDatabase
+from RunCheckpoint_V1R1 import checkpoint_file, manifest, save_checkpoint
+from RunCheckpoint_V1R1 import load_checkpoint, remove_checkpoint, catch_up
 
 HOST = ''           #If blank means any client can connect
 PORT = 50007        #Port address
+ENCLOSURE = None    #IP address of the ESP8266 to graph. None takes any
+SINGLE_RRD = True   #All sensors in one RRD file. False for one per sensor
+RRD_FLUSH = 300     #Seconds measurements wait in memory. 0 writes each one
+RESULTS_COMPANION = 'csv' #or 'jsonl', or None for no companion file
+SAVE_READINGS = True #Keep every raw reading in filename_readings
+DATABASE = None     #SQLite file to add every run to, None for none
+GRAPH_WINDOWS = whole_run #or hour_day_week for the last hour, day and week too
+GRAPH_PLOTTER = 'rrdtool' #or 'matplotlib', drawing on every core
+GRAPH_FILES = True  #False draws graphs only when the dashboard asks
+DASHBOARD_PORT = None #or 8080 for a web page of the run on the network
+MISSED_MEASUREMENTS = 'skip' #or 'catch up' or 'unknown'
+PREFETCH = True #Get the data just before each measurement is due
 
 frame_length = 20  # One frame is all the data for one device.
+max_data_age = 60  # Seconds a cached frame set is good for a measurement
+last_sequence = 0  # Listener sequence number of the data last used
 
 global start_time
 
         
-def retrieve_data():
+def retrieve_data(fresh = False, timeout = 10.0):
     """ 
     Called from get_stored_data() and get_measurements()
 
@@ -65,38 +97,34 @@ def retrieve_data():
     The Raspberry Pi acts as the server while the ESP8266 is the
     client.  
 
-    Once we issue the listen command, the client should respond with all
-    the data.  The data is in one long string with the elements separated
-    with commas.
+    The listener thread accepts every push from the ESP8266s, puts the
+    frames back together however many reads that takes, and keeps the
+    last good one from each.  The ESP8266 sends either comma separated
+    text or, if its firmware takes up the listener's offer, raw binary
+    frames.  Either way recv_data is a bytearray, one element per byte.
+
+    ENCLOSURE picks which enclosure we graph.  Normally we take the cached
+    data, as long as it is not older than max_data_age.  If fresh is True
+    we want a push newer than the one we used last time, so we wait for
+    it.
     
-    If we cannot connect to the client within the timeout period,
-    10 seconds, we return 0 as the number of sensors.
+    If nothing suitable arrives within timeout seconds, we return 0 as
+    the number of sensors.
     """
     
     global recv_data
-    recv_data = [] # Where Gertboard data will go
-    sensors = 0
-
-    try:
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM) #IPv4 TCP/IP
-        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        s.bind((HOST, PORT))
-        s.settimeout(10.0)
-   
-        #Receives all data from client
-        s.listen(1)    
-        conn, addr = s.accept() 
-        dataFromESP = str(conn.recv(1024))
-        conn.close()
-        s.close()
-        
-        recv_data = dataFromESP.split(",")
-        sensors = len(recv_data) / frame_length
-        return sensors
-        
-    except:
-        s.close()        
-        return 0  #failure
+    global last_sequence
+    recv_data = [] # Where ESP8266 data will go
+
+    sequence, sensors, frame_set = listener.latest(max_data_age, ENCLOSURE)
+    if not sensors or (fresh and sequence <= last_sequence):
+        sequence, sensors, frame_set = listener.wait_for_new(sequence,
+            timeout = timeout, enclosure = ENCLOSURE)
+
+    if sensors:
+        last_sequence = sequence
+        recv_data = frame_set
+    return sensors
     
 def get_order(num_sensors):
     """
@@ -108,7 +136,7 @@ def get_order(num_sensors):
     orig_order = []  # Device numbers as received
     sorted_order = [] # Device numbers put in numerical order
     for i in range(num_sensors):
-        orig_order.append(int(recv_data[20 * i + 18]))
+        orig_order.append(recv_data[20 * i + 18])
 
     sorted_order = sorted(orig_order)
     return sorted_order
@@ -118,129 +146,256 @@ def get_stored_data():
      Called to retrieve number of sensors, device numbers, and resolution
      Reads Gertboard data twice.  Number of sensors and sorted device
         numbers must match to pass
-     Makes three tries with 1 munute between tries
+     Makes three tries, waiting up to 5 and then 10 seconds between them
      If we pass, returns nuber of sensors and sorted device numbers.  This
         data becomes constant.  Subsequent reads are compared to these values
      If we fail, returns 0 for number of sensors and empty string for sorted
         device numbers.  Program will subsequently halt.
     """
     
-    trials = 0
     global missed_attempts
-    while trials < 3:
+    retry = RetryPolicy(first = 5.0, longest = 20.0)
+    retry.start()
+    while True:
         first_sensors = retrieve_data()
-        if first_sensors > 0:
+        if first_sensors > 0 and not check_frames(recv_data)[1]:
             first_sorted_order = get_order(first_sensors)
 
-            second_sensors = retrieve_data()
-            if second_sensors == first_sensors:
+            second_sensors = retrieve_data(fresh = True)
+            if (second_sensors == first_sensors and
+                    not check_frames(recv_data)[1]):
                 second_sorted_order = get_order(second_sensors)
 
                 if first_sorted_order == second_sorted_order:
                     return first_sensors, first_sorted_order # good result
 
-        trials += 1
-        time.sleep(10)
+        if not retry.wait():
+            break
         print "Glitch retrieving stored data, trying again"
-        
+
     print "\nThree missed attempts. No more tries!"
     return 0, []  # if failed
         
+def check_manifest(sensors):
+    """
+    Called instead of get_stored_data() when a run is resumed.
+    Reads the data once and checks that the sensors are the ones the run
+       started with: the same sensor numbers, names and resolutions.
+    Makes three tries, waiting up to 5 and then 10 seconds between them
+    If we pass, returns nuber of sensors and sorted device numbers.
+    If we fail, returns 0 for number of sensors and empty string for sorted
+       device numbers.  Program will subsequently halt.
+    """
+
+    retry = RetryPolicy(first = 5.0, longest = 20.0)
+    retry.start()
+    while True:
+        num_sensors = retrieve_data()
+        if num_sensors > 0 and not check_frames(recv_data)[1]:
+            if manifest(SensorRegistry().from_frames(recv_data,
+                    frame_length)) == sensors:
+                return num_sensors, get_order(num_sensors) # good result
+            print "\nThese are not the sensors the run started with"
+            return 0, []
+
+        if not retry.wait():
+            break
+        print "Glitch retrieving stored data, trying again"
+
+    print "\nThree missed attempts. No more tries!"
+    return 0, []  # if failed
+
 def get_measurement(original_sorted_order):
     """
     Called to obtain the data from Gertboard for the measuremsnts.
     Calls retrieve_data() and get_order()
     Checks that the number of sensors and the sorted order of device numbers
       match what was obtained at the start of the program.
-    If a match does not occur, we try twice more.  If a match fails, we
-      return False.
+    Every frame must pass its CRC.  A frame that fails is thrown away and
+      counted against its sensor.  Good frames are kept, so when we try
+      again we only need the frames still missing.
+    If a match does not occur, we try twice more, as long as there is
+      time before the next measurement.  If a match fails, we return False.
     In the process, recv_data[] is updated with current data
     """
 
     trials = 0
+    global recv_data
     global error_sensor_number
     global error_sensor_order
-    
-    while trials < 3:
-        if retrieve_data() != no_sensors:
+    global rejected_frames
+    cycle_frames = {}  # frames with a good CRC so far, by device number
+    rejected_frames = bytearray()  # frames that failed, for the readings
+
+    # The tries may take until the next measurement has to be started on
+    measurement_retry.start(scheduler.time_left())
+    while True:
+        if retrieve_data(fresh = trials > 0,
+                timeout = measurement_retry.timeout(10.0)) != no_sensors:
             error_sensor_number += 1
+            record_event('wrong number of sensors')
         else:
-            if  get_order(no_sensors) != original_sorted_order:
+            good, bad = check_frames(recv_data)
+            if bad:
+                for j in range(no_sensors):
+                    if not frame_ok(recv_data, j):
+                        rejected_frames += recv_data[frame_length * j:
+                            frame_length * (j + 1)]
+            for number in bad:
+                if registry.lookup(number) is None:
+                    number = None  # the sensor number itself is corrupted
+                error_crc[number] = error_crc.get(number, 0) + 1
+                record_event('crc', number)
+
+            wrong_order = False
+            for number in good:
+                if registry.lookup(number) is not None:
+                    cycle_frames[number] = good[number]
+                else:
+                    wrong_order = True
+            if wrong_order:
                 error_sensor_order += 1
-            else:
-                return True    
-    
+                record_event('wrong sensor order')
+
+            if len(cycle_frames) == no_sensors:
+                # recv_data becomes the good frames in sorted order
+                recv_data = bytearray().join([cycle_frames[number]
+                    for number in original_sorted_order])
+                break
+
         trials += 1
-        time.sleep(1.2 * no_sensors)
-        
-    return False
+        if not measurement_retry.wait():
+            break
+
+    measurement_retry.finish()
+    return len(cycle_frames) == no_sensors
             
 
+def record_event(kind, number = None):
+    """
+    Called when a measurement goes wrong.
+    Adds it to the database, if we have one, and tells the dashboard's
+    live stream.
+    """
+    if database:
+        database.event(kind, number)
+    if dashboard:
+        dashboard.event(kind, number)
+
+
+def save_run(flushed):
+    """
+    Called before the first measurement, and by the results writer each
+    time the results have gone to their files.  flushed is the number of
+    the last measurement in the files.
+    Saves what --resume needs to continue the run after it if the program
+    stops, so the checkpoint never counts a measurement the results file
+    does not have.
+    """
+    save_checkpoint(checkpoint_name, {
+        'settings': variable_list,
+        'sensors': manifest(registry),
+        'single_rrd': single_rrd,
+        'database_run': database.run if database else None,
+        'start_time': start_time,
+        'interval': measurement_interval,
+        'next_meas_time': start_time + (flushed + 1) * measurement_interval,
+        'measurement': flushed + 1,
+        'measurements_left': int(variable_list[4]) - flushed,
+        'rrd_written': store.written,
+        'errors': [error_no_data, error_sensor_number, error_sensor_order,
+            sorted(error_crc.items())]})
+
+
+def stop_run(signum, frame):
+    """
+    Called when the terminal is closed or the program is killed, as when
+    the Pi shuts down.
+    Ends the run the same way as CTRL C, so what is waiting in memory is
+    written to the results and RRD files, but keeps the checkpoint so the
+    run can be resumed.
+    """
+    global stopped_by_signal
+    stopped_by_signal = True
+    raise(KeyboardInterrupt)
+
 # ----------------------------------------------------------------------------
 
 # Main Program
 
+parser = argparse.ArgumentParser(description = "Graphs remote temperatures")
+parser.add_argument("--resume", metavar = "FILENAME",
+    help = "continue the run with this base file name that was stopped by "
+    "a crash or shutdown")
+args = parser.parse_args()
+
 variable_list = ["", "", "", 0, 0, 0, "", True]
+checkpoint = None
+checkpoint_name = None
+stopped_by_signal = False
+single_rrd = SINGLE_RRD
 error_no_data = 0
 error_sensor_number = 0
 error_sensor_order = 0
+error_crc = {}  # CRC failures by device number, None if unknown
+rejected_frames = bytearray()  # this measurement's frames that failed
+store = None
+pipeline = None
+renderer = None
+dashboard = None
+scheduler = None
+measurement_retry = None
+results = None
+readings = None
+database = None
+signal.signal(signal.SIGTERM, stop_run)
+signal.signal(signal.SIGHUP, stop_run)
 
 print
 print "     Retrieving Transmitted Data - This will take a few seconds"
 print
 
+# The processes drawing the graphs start before any thread does
+plotter = choose_plotter(GRAPH_PLOTTER)
+
+# Listen for the ESP8266 for the whole run
+listener = WiFiListener(HOST, PORT, frame_length)
+listener.start()
+
 try:
 
     # Retrieve number of sensors, descriptions, and device number    
     original_sorted_order = []
-    no_sensors, original_sorted_order = get_stored_data()
+    if args.resume:
+        checkpoint = load_checkpoint(checkpoint_file(args.resume))
+        if not checkpoint:
+            print "\nNo stopped run to resume. Exiting program"
+            raise(KeyboardInterrupt)
+        no_sensors, original_sorted_order = check_manifest(
+            checkpoint['sensors'])
+    else:
+        no_sensors, original_sorted_order = get_stored_data()
 
     if not no_sensors:  # Failed to get stored data after 3 tries
         print "\nData failure. Exiting program"
         raise(KeyboardInterrupt)
 
-    #Check that there are not more than 12 sensors
-    if no_sensors > 12:
-        print "     You have selected %d sensors.  The maximum is 12." % no_sensors
-        raise(KeyboardInterrupt)
-
-    sensor_name = []   # description entered by user at sending unit
-    device_number = [] # device number given by sending unit
-    resolution = []    # resolutuon (9 - 12) entered by user at sending unit
-    
-    # search by sensor number get sensor descriptions, resolutions, and device
-    #    numbers
-    for i in range(no_sensors):
-        for j in range(no_sensors):
-            if int(recv_data[20 * j + 18]) == original_sorted_order[i]:
-        
-                # get description
-                found_end = False
-
-                if int(recv_data[20 * j + 6]) == 10: # found end of line
-                     description = "No Descrip."
-                else:
-                    description = chr(int(recv_data[20 * j + 6]))
-                for k in range(1, 12):
-                    if int(recv_data[20 * j + 6 + k]) == 10: #found end of line
-                        break
-                    else:
-                        description = (description +
-                            chr(int(recv_data[20 * j + 6 + k])))
-                        
-                # escape colons in the description
-                description = description.replace(":", "\:")
-
-                # get resolution
-                resolution.append((int(recv_data[20 * j + 5]) >> 5) + 9)
-
-                # get device number
-                device_number.append(int(recv_data[20 * j + 18]))
-
-        sensor_name.append(description)
-
-    #Retrieve data from GUI    
-    variable_list = guiwindow()
+    # Get sensor descriptions, resolutions, and device numbers.  Each
+    #    sensor gets a slot in the order of its device number
+    registry = SensorRegistry().from_frames(recv_data, frame_length)
+
+    # Temperature conversion tables, with each sensor's calibration
+    calibration = load_calibration()
+    for sensor in registry:
+        sensor.conversion = conversion_table(sensor.resolution,
+            calibration.get(sensor.number))
+
+    #Retrieve data from GUI, or the checkpoint of the run we resume
+    if checkpoint:
+        variable_list = checkpoint['settings']
+        single_rrd = checkpoint['single_rrd']
+    else:
+        variable_list = guiwindow()
     
     if variable_list[7]:
         raise(KeyboardInterrupt)
@@ -252,10 +407,14 @@ try:
     max_measurements = int(variable_list[4])
     measurement_interval = variable_list[5]
     filename = variable_list[6]
+    checkpoint_name = checkpoint_file(filename)  # for --resume
     
     print
-    for i in range(no_sensors):
-        print "name for sensor %d: %s" % (device_number[i], sensor_name[i])
+    for sensor in registry:
+        print "name for sensor %d: %s" % (sensor.number, sensor.name)
+        if sensor.conversion.correction:
+            print ("  calibration: %+.4f at 0 C, %+.4f at 100 C" %
+                sensor.conversion.correction)
     print "graph title: ", title_it
     print "comment: ", comment
     print "background color: ", background
@@ -263,98 +422,80 @@ try:
     print "maximum number of measurements: ", max_measurements
     print "measurement interval: ", measurement_interval
     print "base file name: ", filename
+    print "storing with the", backend_name
+    print "graphing with", plotter
+    print "timing with the", clock_name
     print
 
-    start_time = int(time.time() / measurement_interval) * measurement_interval
-    next_meas_time= start_time + measurement_interval
-
-
-    # File names
-    
-    graphfile_blk = filename + '_black.png'
-    graphfile_wht = filename + '_white.png'
-    resultsfile = filename + '.txt'
-
-    rrdfile = []
-    for i in range(no_sensors):
-       rrdfile.append(filename + '_sensor' +  str(i + 1) + '.rrd')
-                      
-        
+    if checkpoint:
+        # carry on with the run's schedule
+        start_time = checkpoint['start_time']
+        next_meas_time, measurement, max_measurements, missed = catch_up(
+            checkpoint, time.time())
+        error_no_data, error_sensor_number, error_sensor_order = \
+            checkpoint['errors'][:3]
+        error_crc = dict(checkpoint['errors'][3])
+        print ('Resuming the run started at ' +
+            time.asctime(time.localtime(start_time)))
+        print "measurements missed while stopped: ", missed
+        print
+    else:
+        start_time = int(time.time() / measurement_interval) * measurement_interval
+        next_meas_time= start_time + measurement_interval
+        measurement = 1
+
+
+    # Setup results file, and its companion for other programs.  Each
+    #    time they are written they go straight to the SD card and the
+    #    checkpoint is saved
+    results = ResultsWriter(filename, RESULTS_COMPANION, sync = True)
+    if checkpoint:
+        results.resume(registry)
+    else:
+        results.header(title_it, registry, comment)
+
+    # Every raw reading, added to any from earlier runs with this file name.
+    # Not synced, a power cut can lose the last half minute of readings.
+    if SAVE_READINGS:
+        readings = ReadingStore(filename + '_readings')
+
+    # The run, its sensors, readings and errors in the database
+    if DATABASE:
+        database = TemperatureDatabase(DATABASE)
+        if checkpoint and checkpoint['database_run']:
+            database.resume_run(checkpoint['database_run'], registry)
+        else:
+            database.start_run(title_it, comment, measurement_interval,
+                start_time, filename, registry)
 
-    # Setup results file
-    try:
-        f = open(resultsfile, 'w')
-        try:
-            f.write("Graph Title: %s \n\n" %title_it)
-            for i in range(no_sensors):
-                f.write("Measuring: %s, Sensor number: %d, Resolution: %d bits\n"
-                        %(sensor_name[i], device_number[i], resolution[i]))            
-            if comment != "":
-                f.write("\nGraph Comments: %s \n" %comment)
-            f.write("\n\n")
-        finally:
-            f.close()
-    except:
-        print '\nCould not write to the file\n'                  
-
-
-    # Graph colors:
-    colors = []
-    colors.append('#FF0000') # Red
-    colors.append('#0000FF') # Blue
-    colors.append('#00FF00') # Green
-    colors.append('#00FFFF') # Cyan
-    colors.append('#FFFF00') # Yellow
-    colors.append('#FF00FF') # Magenta
-    colors.append('#FF8000') # Orange
-    colors.append('#804000') # Brown
-    colors.append('#408080') # Gray Green
-    colors.append('#FF80FF') # Pink
-    colors.append('#408040') # Dark Green
-    colors.append('#0040C0') # Dark Blue
 
     # Setup RRD Files and Graph
-    dsName = []
-    device = []
-    device_def = []
-    device_line = []
-    device_aver = []
-    device_val = []
-    vname = []
-    
-    
-    for i in range(no_sensors):        
-        #  RRD Setup
-        dsName.append("Sensor" + str(i))
-
-        dataSources = []
-        roundRobinArchives = []
-        dataSource = (DataSource(dsName=dsName[i], dsType='GAUGE',
-                heartbeat=int(1.5 * measurement_interval)))
-        dataSources.append(dataSource)
-
-        roundRobinArchives.append(RRA(cf='LAST', xff=0.5, steps=1, \
-                rows=max_measurements))
-      
-        device.append(RRD(rrdfile[i], step=measurement_interval,
-                ds=dataSources, rra=roundRobinArchives, start=start_time))
-        device[i].create(debug=False)
-
+    store = TemperatureStore(filename, registry, measurement_interval,
+        int(variable_list[4]), start_time, single_rrd, RRD_FLUSH)
+    if checkpoint:
+        # The measurements the RRD files missed when the run stopped come
+        #    back from the results companion file
+        stored = store.reopen(results.rows_after(checkpoint['rrd_written']
+            or start_time))
+        if stored:
+            print "Stored %d measurements left from the last run" % stored
+            print
+    else:
+        store.create()
+
+    for sensor in registry:
         #  Graph Setup
-        device_def.append(DEF(rrdfile=rrdfile[i], vname= dsName[i] + '_data',
-                dsName=dsName[i], cdef='LAST'))
-        device_line.append(LINE(defObj=device_def[i], color=colors[i],
-                legend=sensor_name[i] + ' Temperature'))
-        device_aver.append(VDEF(vname= dsName[i] + '_aver',
-                rpn='%s,AVERAGE' % device_def[i].vname))
-        device_val.append(GPRINT(device_aver[i], 'Average ' +
-                sensor_name[i] + ' Temperature: %6.2lf Degrees F'))
+        sensor.graph_def = DEF(rrdfile=sensor.rrdfile,
+                vname=sensor.ds_name + '_data', dsName=sensor.ds_name,
+                cdef='LAST')
+        sensor.graph_line = LINE(defObj=sensor.graph_def, color=sensor.color,
+                legend=sensor.name + ' Temperature')
+        sensor.graph_aver = VDEF(vname=sensor.ds_name + '_aver',
+                rpn='%s,AVERAGE' % sensor.graph_def.vname)
+        sensor.graph_val = GPRINT(sensor.graph_aver, 'Average ' +
+                sensor.name + ' Temperature: %6.2lf Degrees F')
                         
 
-    # Graph Comment    
-
-    cmt = COMMENT(comment)
-
     # Define Graph Colors
     #    black background:
     black_bkgnd = ColorAttributes()
@@ -379,6 +520,33 @@ try:
     white_bkgnd.frame = '#0000AA'
     white_bkgnd.font = '#000000'   
     white_bkgnd.arrow = '#000000'
+
+    # Every graph asked for, in each background, is drawn from one read
+    #    of the RRD files, in its own thread.  Without graph files they
+    #    are only drawn for the dashboard
+    themes = []
+    if background == '0' or background == '2':
+        themes.append(('_black', black_bkgnd))
+    if background == '1' or background == '2':
+        themes.append(('_white', white_bkgnd))
+    pipeline = GraphPipeline(filename, store, registry, start_time, title_it,
+        comment, how_high, themes, GRAPH_WINDOWS)
+    if GRAPH_FILES:
+        renderer = GraphRenderer(pipeline.draw)
+        renderer.start()
+
+    # The run in a browser
+    if DASHBOARD_PORT:
+        try:
+            dashboard = DashboardServer(registry, store, pipeline,
+                {'black': black_bkgnd, 'white': white_bkgnd}, readings,
+                port = DASHBOARD_PORT, refresh = measurement_interval,
+                theme = background == '1' and 'white' or 'black')
+            dashboard.start()
+            print "Dashboard: http://%s:%d/" % (socket.gethostname(),
+                DASHBOARD_PORT)
+        except socket.error, e:
+            print "\nCould not start the dashboard: %s\n" % e
     
 
     
@@ -386,120 +554,101 @@ try:
     print ('First Measurement Will Be Made At: ' +
         time.asctime(time.localtime(next_meas_time)))
     print
-    
-    measurement = 1
+
+    # Sleeps until each measurement is due, or with PREFETCH until it is
+    #    time to start getting its data.  The time each is made goes in
+    #    filename_schedule.csv
+    scheduler = MeasurementScheduler(measurement_interval,
+        MISSED_MEASUREMENTS,
+        prefetch = LatencyEstimate('WiFi') if PREFETCH else None)
+    scheduler.open_log(filename + '_schedule.csv')
+
+    # Waits between tries at a measurement start short and double, up to
+    #    the time it takes the enclosure to send all the sensors again
+    measurement_retry = RetryPolicy(longest = 1.2 * no_sensors)
+
+    save_run(measurement - 1)
+    results.on_flush = save_run
     while max_measurements:
         # waiting for next measurement
-        time_now = time.time()
-        while time_now < next_meas_time:
-            time.sleep(0.5)
-            time_now = time.time()
-            
+        next_meas_time, missed = scheduler.wait(next_meas_time,
+            max_measurements - 1)
+        if missed:
+            print "Missed %d Measurements" % missed
+            print
+            for i in range(missed, 0, -1):
+                record_event('missed')
+                if MISSED_MEASUREMENTS == 'unknown':
+                    store.update(next_meas_time - i * measurement_interval,
+                        [None] * no_sensors)
+            measurement += missed
+            max_measurements -= missed
+
+        # Now we get the data.  With PREFETCH we are early, and
+        #    acquired() holds it until the measurement is due
+        got_data = get_measurement(original_sorted_order)  # retrieve data
+        scheduler.acquired(got_data, measurement_retry.last[0] > 0)
+
         timenow = datetime.now()
     
         # Putting the measurment time into the results text file
-        try:
-            f=open(resultsfile, 'a')
-            try:
-                f.write("Measurement: %d. %d to go\n" % (measurement, (max_measurements -1)))
-                f.write(timenow.strftime("%A, %B %d, %I:%M:%S %p:\n"))
-            finally:
-                f.close()
-        except(IOError):
-            print '\nCould not write to the file\n'
+        results.measurement(measurement, max_measurements - 1, timenow,
+            next_meas_time)
                                 
-        # Now we get the data and retrieve the temperature
-        temp_f = []
-        
         print "Measurement: %d. %d to go" % (measurement, (max_measurements -1))
         print timenow.strftime("%A, %B %d, %I:%M:%S %p:")
-
-        if get_measurement(original_sorted_order):  # retrieve the data
-            for i in range(no_sensors):
-                for j in range(no_sensors):
-                    if int(recv_data[20 * j + 18]) == original_sorted_order[i]:
-                        temp_c = (256 * int(recv_data[20 * j + 2]) +
-                            int(recv_data[20 * j + 1]))
-                        if int(recv_data[20 * j + 2]) > 127:
-                            temp_c -= 65536
-
-                        temp_c /= 16.0
-                        temp_f.append(round(1.8 * temp_c + 32.0, 1))
-
-                        # print result to the terminal
-                        print (" The %s sensor temperature is %3.1f" %
-                            (sensor_name[i], temp_f[i]) + u"\xB0" +"F")
-
-                        # temperature result to the graph
-                        device[i].bufferValue(next_meas_time, str(temp_f[i]))
-                        device[i].update(debug = False)
-
-            #append temperature results to the results text file
-            try:
-                f = open(resultsfile, 'a')                
-                for i in range(no_sensors):                    
-                    try:
-                        f.write((" The %s sensor temperature is %3.1f")
-                            %(sensor_name[i], temp_f[i]) + " degF\n")                        
-                    except(IOError):
-                        print '\nCould not write to the file\n'
-            except(IOError):
-                print '\nCould not open the file\n'
-            f.close()
-
-            #skip a line in the file after last sensor
-            try:
-                f = open(resultsfile, 'a')
-                try:
-                    f.write("\n")
-                finally:
-                    f.close()
-            except(IOError):
-                print '\nCould not write to the file\n'
-
-            # write to the graph files
-            gb = Graph(graphfile_blk, start = start_time,
-                end = next_meas_time - measurement_interval, color = black_bkgnd,
-                vertical_label='Degrees\ F', width=600, height=how_high,
-                title=title_it)
-            gw = Graph(graphfile_wht, start = start_time,
-                end = next_meas_time - measurement_interval, color = white_bkgnd,
-                vertical_label='Degrees\ F', width=600, height=how_high,
-                title=title_it)
-
-            for i in range(no_sensors):
-                gb.data.extend([device_def[i], device_line[i],
-                    device_aver[i], device_val[i]])
-                gw.data.extend([device_def[i], device_line[i],
-                    device_aver[i], device_val[i]])
-            
-            if comment:
-                gb.data.extend([cmt])
-                gw.data.extend([cmt])
-            
-            if background == '0' or background == '2':          
-                gb.write()
-            if background == '1' or background == '2':          
-                gw.write()
+        if measurement_retry.last[0]:
+            print " Retries: %d, %.1f seconds" % measurement_retry.last
+
+        # every raw reading, with the frames that failed their CRC
+        if readings and (got_data or rejected_frames):
+            readings.append(next_meas_time, recv_data if got_data else '',
+                rejected_frames)
+
+        if got_data:
+            # one lookup per frame finds the sensor's slot, one more its
+            #    calibrated temperature
+            temp_f = [0.0] * no_sensors
+            for frame in decode_frames(recv_data):
+                sensor = registry.lookup(frame[6])
+                temp_f[sensor.slot] = sensor.conversion.to_fahrenheit(frame[1])
+            if database:
+                database.readings(next_meas_time, recv_data, temp_f)
+
+            # print result to the terminal
+            for sensor in registry:
+                print (" The %s sensor temperature is %3.1f" %
+                    (sensor.name, temp_f[sensor.slot]) + u"\xB0" +"F")
+
+            # temperature results to the graph.  They may wait in memory
+            #    to be written to the RRD files with later ones.  Each time
+            #    they are written the renderer draws the graph files while
+            #    we wait for the next measurement
+            if store.update(next_meas_time, temp_f) and renderer:
+                renderer.request(store.written - measurement_interval)
+
+            #append temperature results to the results text file, and
+            #    skip a line in the file after last sensor
+            results.temperatures(temp_f)
+            if dashboard:
+                dashboard.update(next_meas_time, measurement, temp_f)
 
         # what to do if a measurement fails
         else:
             error_no_data += 1
+            record_event('no data')
             print " Failed to retrieve data"
             
             # print failure message to results text file
-            try:
-                f = open(resultsfile, 'a')                
-                try:
-                    f.write(" Failed to retrieve data\n\n")
-                except(IOError):
-                    print '\nCould not write to the file\n'
-            except(IOError):
-                print '\nCould not open the file\n'
-            f.close()
+            results.failed()
                             
         print # skip a line after the last sensor                                              
 
+        # the results go to the file every few measurements
+        results.end_cycle()
+        if database:
+            database.end_cycle()
+
         # setup for next measurement
         next_meas_time += measurement_interval
         measurement += 1
@@ -510,13 +659,66 @@ except(KeyboardInterrupt):
 
 if not variable_list[7]:
 
+    # write the measurements still waiting in memory and graph them
+    if dashboard:
+        dashboard.stop()
+    if store:
+        pending = store.pending
+        store.close()
+        if pending and renderer:
+            renderer.request(store.written - measurement_interval)
+    if renderer:
+        renderer.close()
+    if pipeline:
+        pipeline.close()
+    if readings:
+        readings.close()
+    if database:
+        database.close()
+
+    # a run stopped by a shutdown can be resumed, one that ends or is
+    #    stopped with CTRL C is over
+    if stopped_by_signal:
+        print
+        print "Run stopped.  Continue it with --resume %s" % filename
+    elif checkpoint_name:
+        if results:
+            results.on_flush = None
+        remove_checkpoint(checkpoint_name)
+
     print
     print "See you later"
     print
     print "Instances of No data Received: %d" % error_no_data
     print "Instances of Wrong Number of Sensors: %d" % error_sensor_number
     print "Instances of Wrong Sensor Order: %d" % error_sensor_order
+    print "Instances of CRC Errors: %d" % sum(error_crc.values())
+    for number in sorted(error_crc.keys()):
+        if number is None:
+            print "  Unknown Sensor: %d" % error_crc[number]
+        else:
+            print "  Sensor Number %d: %d" % (number, error_crc[number])
+    print "Pushes From ESP8266: %d, Rejected: %d" % (listener.pushes,
+        listener.rejected)
     
+    if store and store.duplicates:
+        print "Measurements Already In The RRD Files: %d" % store.duplicates
+    if scheduler:
+        scheduler.close()
+        for line in scheduler.summary():
+            print line
+    if measurement_retry:
+        for line in measurement_retry.summary("Measurements"):
+            print line
+    if renderer:
+        for line in renderer.summary():
+            print line
+    if pipeline:
+        for line in pipeline.summary():
+            print line
+    if dashboard:
+        print "Live Stream Messages: %d, Slow Listeners Dropped: %d" % (
+            dashboard.stream.published, dashboard.stream.dropped)
     print           
     print "To look at the .rrd flies you need:"
     print "  start time: ", start_time
@@ -535,24 +737,31 @@ if not variable_list[7]:
     print 'Total Number of Measurements Per Device: ' + str(total_measurements)
     print
 
-    try:
-        f = open(resultsfile, 'a')                
-        try:
-            f.write("Instances of No Data Received: %d\n" % error_no_data)
-            f.write("Instances of Wrong Number of Sensors: %d\n" % error_sensor_number)
-            f.write("Instances of Wrong Sensor Order: %d\n\n" % error_sensor_order)
-            f.write("To look at the .rrd flies you need:\n")
-            f.write("  Start time: %d\n" % start_time)
-            f.write("  Last measurement: %d\n\n" % next_meas_time)
-            f.write("Total Run Time: %2d days, %2d hours, %2d minutes\n"
-                % (run_days, run_hours, run_minutes))
-            f.write("Total Number of Measurements Per Device: %d\n" %
-                total_measurements)
-        except(IOError):
-            print '\nCould not write to the file\n'
-    except(IOError):
-        print '\nCould not open the file\n'
-    f.close()   # close the results file
+    if results and stopped_by_signal:
+        results.close()
+    elif results:
+        results.write("Instances of No Data Received: %d\n" % error_no_data)
+        results.write("Instances of Wrong Number of Sensors: %d\n" %
+            error_sensor_number)
+        results.write("Instances of Wrong Sensor Order: %d\n" %
+            error_sensor_order)
+        results.write("Instances of CRC Errors: %d\n" %
+            sum(error_crc.values()))
+        for number in sorted(error_crc.keys()):
+            if number is None:
+                results.write("  Unknown Sensor: %d\n" % error_crc[number])
+            else:
+                results.write("  Sensor Number %d: %d\n" % (number,
+                    error_crc[number]))
+        results.write("\n")
+        results.write("To look at the .rrd flies you need:\n")
+        results.write("  Start time: %d\n" % start_time)
+        results.write("  Last measurement: %d\n\n" % next_meas_time)
+        results.write("Total Run Time: %2d days, %2d hours, %2d minutes\n"
+            % (run_days, run_hours, run_minutes))
+        results.write("Total Number of Measurements Per Device: %d\n" %
+            total_measurements)
+        results.close()   # close the results file
                             
  
 
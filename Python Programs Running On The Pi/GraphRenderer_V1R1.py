@@ -0,0 +1,145 @@
+#!/usr/bin/python
+
+"""
+Draws the graphs in a background thread, so the measurement loop never
+waits for rrdtool.
+
+Drawing the graphs takes longer as a run's history grows.  Drawn in the
+measurement loop, it can push the next measurement late.  Here the loop
+only asks for a drawing with request() and goes straight back to waiting
+for its next measurement.  The thread draws whenever it is asked to.
+
+Only one request waits at a time.  If a newer one comes in before the
+thread has started on the one waiting, the newer one replaces it.  A graph
+drawn to a later end time shows everything the earlier one would have, so
+nothing is lost.  The thread is never more than one drawing behind.
+
+For every drawing the time from the request to the finished graph is
+measured, waiting included.  summary() reports it.
+"""
+
+import threading
+import time
+
+
+class GraphRenderer(threading.Thread):
+    """
+    Background thread that calls draw(end) for the newest request.
+
+    Call start() once, request(end) whenever the graphs should be drawn to
+    end, and close() at the end of the run.  close() draws a request that
+    is still waiting before it returns.
+    """
+
+    def __init__(self, draw):
+        threading.Thread.__init__(self)
+        self.daemon = True    # do not keep the program alive on exit
+
+        self.draw = draw
+        self.condition = threading.Condition()
+        self.waiting = None   # (end, time requested) of the next drawing
+        self.closing = False
+
+        self.requested = 0
+        self.drawn = 0
+        self.replaced = 0     # requests replaced by a newer one
+        self.failed = 0
+        self.latency = []     # seconds from request to graph, each drawing
+        self.draw_time = []   # seconds drawing, each drawing
+
+    def request(self, end):
+        """
+        Asks for the graphs to be drawn to end.  Returns at once.
+        """
+        self.condition.acquire()
+        try:
+            self.requested += 1
+            if self.waiting:
+                self.replaced += 1
+            self.waiting = (end, time.time())
+            self.condition.notify()
+        finally:
+            self.condition.release()
+
+    def run(self):
+        while True:
+            self.condition.acquire()
+            try:
+                while not self.waiting and not self.closing:
+                    self.condition.wait()
+                if not self.waiting:
+                    return
+                end, requested = self.waiting
+                self.waiting = None
+            finally:
+                self.condition.release()
+
+            begin = time.time()
+            try:
+                self.draw(end)
+                self.drawn += 1
+            except Exception, e:
+                self.failed += 1
+                print "\nCould not draw the graphs: %s\n" % e
+            finished = time.time()
+            self.latency.append(finished - requested)
+            self.draw_time.append(finished - begin)
+
+    def close(self, timeout = None):
+        """
+        Draws any request still waiting, then stops the thread.
+        """
+        self.condition.acquire()
+        try:
+            self.closing = True
+            self.condition.notify()
+        finally:
+            self.condition.release()
+        if self.is_alive():
+            self.join(timeout)
+
+    def summary(self):
+        """
+        Lines for the terminal at the end of the run.
+        """
+        lines = ["Graphs Drawn: %d, Skipped For A Newer One: %d, Failed: %d"
+            % (self.drawn, self.replaced, self.failed)]
+        if self.latency:
+            lines.append("Graph Latency: average %.2f s, longest %.2f s" %
+                (sum(self.latency) / len(self.latency), max(self.latency)))
+            lines.append("Graph Drawing Time: average %.2f s, longest %.2f s"
+                % (sum(self.draw_time) / len(self.draw_time),
+                max(self.draw_time)))
+        return lines
+
+#---------------------------------------------------------------------
+
+# Test Code
+
+if __name__ == '__main__':
+
+    drawings = []
+
+    def slow_draw(end):
+        time.sleep(0.3)     # rrdtool drawing a long run
+        drawings.append(end)
+
+    renderer = GraphRenderer(slow_draw)
+    renderer.start()
+
+    # measurements every 0.1 s, each asking for the graphs
+    begin = time.time()
+    longest = 0
+    for end in range(1, 11):
+        asked = time.time()
+        renderer.request(end)
+        longest = max(longest, time.time() - asked)
+        time.sleep(0.1)
+    print "10 measurements in %.2f s, longest request %.4f s" % (
+        time.time() - begin, longest)
+    time.sleep(1)
+    renderer.request(11)
+    renderer.close()
+    print "drew ends: ", drawings
+    for line in renderer.summary():
+        print line
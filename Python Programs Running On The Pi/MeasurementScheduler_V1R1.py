@@ -0,0 +1,313 @@
+#!/usr/bin/python
+
+"""
+Wakes the program up for each measurement on time.
+
+The measurement loop used to look at the clock every half second until
+the measurement was due, so a measurement could start up to half a second
+late.  The Pi woke twice a second all run long.  And it went by the wall
+clock, which jumps when NTP sets it, as it does soon after boot on a Pi
+with no real time clock.  Here the program sleeps once, until a deadline
+on the monotonic clock, which never jumps.
+
+The measurement times stay on the grid of the RRD files, start_time plus
+a whole number of intervals.  When the wall clock is set forward, the next
+wait finds the measurement times behind it and moves them onto it, by the
+missed measurement policy.  When it is set back the measurements go on
+from where they were, as the RRD files can only take later times.
+
+When the program wakes a whole interval or more late, because a
+measurement took too long or the clock was set forward, the policy says
+what happens to the measurements it missed:
+
+    'skip'      they are counted as made and left out.  The next
+                measurement is the one due now
+    'catch up'  they are made one after another, straight away
+    'unknown'   as skip, but the program stores them as unknown in the
+                RRD files
+
+Getting the data takes time too: the serial port has to be asked for the
+frame set and read, and a WiFi push may have to be waited for.  Started at
+the measurement time, the data came in after it, though it was stored as
+if read at that moment.  With prefetch the program wakes up early by a
+LatencyEstimate of how long getting the data takes, learned from the
+measurements so far, one for each way the data comes in.  acquired() then
+holds the data until the measurement is due, so the reading is taken at
+the time it is stored under and all that is left for the measurement time
+itself is what is already in memory.
+
+For every measurement the time it was due, the time the program woke up
+for it and the time it had the data are kept, in a CSV file if open_log()
+was called, so the timing can be looked at afterwards.
+"""
+
+import os
+import time
+
+try:
+    import ctypes
+    import ctypes.util
+
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    CLOCK_MONOTONIC = 1     # linux/time.h
+    librt = ctypes.CDLL(ctypes.util.find_library('rt') or
+        ctypes.util.find_library('c'), use_errno = True)
+    clock_gettime = librt.clock_gettime
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+
+    def monotonic():
+        """
+        Seconds on a clock that only ever goes forward.
+        """
+        t = timespec()
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+            raise OSError(ctypes.get_errno(), "clock_gettime")
+        return t.tv_sec + t.tv_nsec * 1e-9
+
+    monotonic()
+    clock_name = "monotonic clock"
+except (ImportError, OSError, AttributeError, TypeError):
+    monotonic = time.time
+    clock_name = "wall clock, no monotonic clock found"
+
+policies = ['skip', 'catch up', 'unknown']
+
+
+class LatencyEstimate(object):
+    """
+    How long getting the data takes, over the serial port or WiFi.  A
+    running average and a running average of the difference from it, the
+    way TCP estimates a round trip.  lead() is the average plus margin times
+    the difference, so a slow measurement now and then is still in hand on
+    time.
+    """
+
+    def __init__(self, transport, gain = 0.125, margin = 4.0):
+        self.transport = transport
+        self.gain = gain
+        self.margin = margin
+        self.average = None
+        self.deviation = 0.0
+        self.samples = 0
+
+    def update(self, seconds):
+        if self.average is None:
+            self.average = seconds
+            self.deviation = seconds / 2
+        else:
+            self.deviation += self.gain * 2 * (abs(seconds - self.average) -
+                self.deviation)
+            self.average += self.gain * (seconds - self.average)
+        self.samples += 1
+
+    def lead(self):
+        """
+        Seconds before the measurement time to start getting the data.
+        """
+        if self.average is None:
+            return 0.0
+        return self.average + self.margin * self.deviation
+
+
+class MeasurementScheduler(object):
+    """
+    The timing of one run's measurements.
+    """
+
+    def __init__(self, interval, policy = 'skip', step_tolerance = 1.0,
+            prefetch = None):
+        if policy not in policies:
+            raise ValueError("missed measurement policy is one of " +
+                ", ".join(policies))
+        self.interval = interval
+        self.policy = policy
+        self.step_tolerance = step_tolerance  # seconds the clock may move
+        self.offset = time.time() - monotonic()  # wall clock - monotonic
+        self.prefetch = prefetch  # LatencyEstimate, None to start on time
+        self.max_lead = interval / 2.0
+        self.max_overshoot = 0.05   # seconds of late waking to learn from
+
+        self.log = None
+        self.scheduled = None   # of the measurement being made
+        self.deadline = None    # the same on the monotonic clock
+        self.started = None
+        self.overrun = False    # no sleep, the last measurement ran over
+        self.lateness = []      # seconds late waking, each measurement
+        self.acquisition = []   # seconds getting the data, each one
+        self.missed = 0
+        self.clock_steps = []   # seconds the wall clock was set forward
+        self.in_hand = []       # seconds the data was in hand before the
+                                # measurement time, negative if after
+
+    def open_log(self, filename):
+        """
+        Adds the timing of every measurement to filename, a CSV file.
+        """
+        try:
+            new = not os.path.exists(filename)
+            self.log = open(filename, 'a')
+            if new:
+                self.log.write("scheduled,started,finished,data\n")
+        except IOError:
+            print '\nCould not open the schedule log\n'
+
+    def wall_time(self, monotonic_time):
+        return monotonic_time + self.offset
+
+    def wait(self, next_meas_time, limit = None):
+        """
+        Sleeps until next_meas_time, a time on the wall clock, or with
+        prefetch until the data should be started on to be in hand by then.
+        Returns the time of the measurement to make now and how many were
+        missed, no more than limit.
+        """
+        offset = time.time() - monotonic()
+        if offset > self.offset + self.step_tolerance:
+            self.clock_steps.append(offset - self.offset)
+            self.offset = offset
+
+        lead = self.lead()
+        deadline = next_meas_time - self.offset
+        remaining = deadline - lead - monotonic()
+        self.overrun = remaining <= 0
+        while remaining > 0:    # more than once only if a signal wakes us
+            time.sleep(remaining)
+            remaining = deadline - lead - monotonic()
+        late = -remaining
+
+        missed = 0
+        if self.policy != 'catch up' and late - lead >= self.interval:
+            missed = int((late - lead) / self.interval)
+            if limit is not None:
+                missed = min(missed, limit)
+            next_meas_time += missed * self.interval
+            deadline += missed * self.interval
+            late -= missed * self.interval
+            self.missed += missed
+
+        self.scheduled = next_meas_time
+        self.deadline = deadline
+        self.started = monotonic()
+        self.lateness.append(late)
+        return next_meas_time, missed
+
+    def time_left(self):
+        """
+        Seconds until the program has to start on the next measurement.
+        """
+        return self.deadline + self.interval - self.lead() - monotonic()
+
+    def lead(self):
+        """
+        Seconds before each measurement time the program wakes up.
+        """
+        if not self.prefetch:
+            return 0.0
+        return min(self.prefetch.lead(), self.max_lead)
+
+    def acquired(self, data, retried = False):
+        """
+        Called when the measurement has its data, or has failed to get
+        it, retried if it took more than one try.  With prefetch, good
+        data is held until the measurement is due, and teaches the
+        latency estimate if it came at the first try after a sleep.  The
+        time the try took and up to max_overshoot of waking up late is
+        learned.  Retry waits and a last measurement that ran over are
+        not part of getting the data, and would put the lead up to
+        max_lead for many measurements after.
+        """
+        finished = monotonic()
+        self.acquisition.append(finished - self.started)
+        if self.prefetch:
+            self.in_hand.append(self.deadline - finished)
+            if data and not retried and not self.overrun:
+                self.prefetch.update(finished - self.started +
+                    min(max(self.lateness[-1], 0.0), self.max_overshoot))
+            remaining = self.deadline - monotonic()
+            while remaining > 0:
+                time.sleep(remaining)
+                remaining = self.deadline - monotonic()
+        if self.log:
+            self.log.write("%d,%.3f,%.3f,%d\n" % (self.scheduled,
+                self.wall_time(self.started), self.wall_time(finished),
+                bool(data)))
+            self.log.flush()
+
+    def summary(self):
+        """
+        Lines for the terminal at the end of the run.
+        """
+        lines = []
+        if self.lateness:
+            ordered = sorted(self.lateness)
+            lines.append("Waking Up Late: average %.1f ms, 95%% within "
+                "%.1f ms, longest %.1f ms" % (1000 * sum(ordered) /
+                len(ordered), 1000 * ordered[int(0.95 * (len(ordered) - 1))],
+                1000 * ordered[-1]))
+        if self.acquisition:
+            lines.append("Getting The Data: average %.2f s, longest %.2f s"
+                % (sum(self.acquisition) / len(self.acquisition),
+                max(self.acquisition)))
+        if self.in_hand:
+            early = len([t for t in self.in_hand if t >= 0])
+            lines.append("Data In Hand On Time (%s): %d of %d, started "
+                "%.2f s early, latest %.2f s after the measurement time" %
+                (self.prefetch.transport, early, len(self.in_hand),
+                self.lead(),
+                max(0, -min(self.in_hand))))
+        if self.missed:
+            lines.append("Measurements Missed: %d (%s)" % (self.missed,
+                self.policy))
+        for step in self.clock_steps:
+            lines.append("Clock Set Forward: %d s" % step)
+        return lines
+
+    def close(self):
+        if self.log:
+            self.log.close()
+            self.log = None
+
+#---------------------------------------------------------------------
+
+# Test Code
+
+if __name__ == '__main__':
+
+    print "timing with the", clock_name
+    for policy in policies:
+        scheduler = MeasurementScheduler(0.2, policy)
+        next_meas_time = time.time() + 0.2
+        made = []
+        while len(made) < 5:
+            next_meas_time, missed = scheduler.wait(next_meas_time)
+            made.append(missed)
+            if len(made) == 2:
+                time.sleep(0.5)     # this measurement takes too long
+            scheduler.acquired(True)
+            next_meas_time += 0.2
+        print "%-8s missed before each measurement: %s" % (policy, made)
+        for line in scheduler.summary():
+            print "  " + line
+
+    # Getting the data takes 0.1 s, 0.25 s the time it is retried
+    scheduler = MeasurementScheduler(0.6, prefetch = LatencyEstimate('test'))
+    next_meas_time = time.time() + 0.6
+    for i in range(6):
+        next_meas_time, missed = scheduler.wait(next_meas_time)
+        time.sleep(0.25 if i == 3 else 0.1)
+        scheduler.acquired(True, i == 3)
+        print "data in hand %.3f s before the measurement, held %.3f s, " \
+            "lead %.3f s" % (scheduler.in_hand[-1],
+            max(0, scheduler.in_hand[-1]), scheduler.lead())
+        next_meas_time += 0.6
+    for line in scheduler.summary():
+        print "  " + line
+
+    # The wall clock is set an hour forward
+    scheduler = MeasurementScheduler(60)
+    scheduler.offset -= 3600
+    now = int(time.time())
+    print "after the clock is set forward: ", scheduler.wait(now - 3600 + 1)
+    print scheduler.summary()[-2:]
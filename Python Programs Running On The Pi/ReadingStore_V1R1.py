@@ -0,0 +1,298 @@
+#!/usr/bin/python
+
+"""
+Keeps every reading just as the sensors sent it, for as long as the run
+lasts.
+
+The RRD files only keep what fits in their archives and the results file
+is written for people to read.  Here each field of the frames is kept in
+its own file, a column of fixed width numbers, one per reading: the
+measurement time, sensor number, raw scratchpad temperature, TH, TL,
+configuration, CRC and flags.  Reading the readings back never parses
+anything.  The files are memory mapped and only the rows asked for are
+copied out.
+
+A small time index has one entry per measurement: its time and how many
+readings there are once it is stored.  Finding the readings between two
+times is a binary search of the index.
+
+The files are only ever appended to.  A measurement counts once its index
+entry is written, after its readings.  If the power goes off part way,
+anything after the last complete index entry is cut off the next time the
+store is opened.  With sync every measurement is forced onto the SD card
+as well.
+
+Without sync, as the programs use it to spare the SD card, a measurement
+waits in Linux's page cache until the kernel writes it back, which is
+within about 35 seconds (30 before a page counts as old, and a flusher
+that runs every 5).  A power cut loses the readings of that last half
+minute or so: the last measurement at one a minute, more at shorter
+intervals.  What is left is still whole measurements.  A program that is
+stopped, or crashes, loses nothing, since the data is already the
+kernel's.
+"""
+
+import bisect
+import mmap
+import os
+import struct
+from array import array
+from DS18B20Frames_V1R1 import decode_frames
+
+# One file per field: name, array type code
+columns = [
+    ('time', 'I'),              # seconds since 1970, as in the RRD files
+    ('number', 'B'),            # sensor number
+    ('temperature', 'h'),       # scratchpad, sixteenths of a degree C
+    ('upper_alarm', 'b'),       # TH, degrees C
+    ('lower_alarm', 'b'),       # TL, degrees C
+    ('configuration', 'B'),     # resolution is (configuration >> 5) + 9
+    ('crc', 'B'),
+    ('flags', 'B'),
+]
+
+# The time index: time of each measurement and the rows once it is stored
+index_columns = [
+    ('index_time', 'I'),
+    ('index_rows', 'I'),
+]
+
+# flags
+CRC_OK = 1
+ALARM_HIGH = 2      # temperature at or above TH
+ALARM_LOW = 4       # temperature at or below TL
+
+
+class Column(object):
+    """
+    A column file, memory mapped, for reading.  Works with bisect.
+    """
+
+    def __init__(self, filename, typecode):
+        self.typecode = typecode
+        self.width = array(typecode).itemsize
+        self.format = struct.Struct(typecode)
+        self.map = None
+        self.length = os.path.getsize(filename) / self.width
+        if self.length:
+            f = open(filename, 'rb')
+            try:
+                self.map = mmap.mmap(f.fileno(), self.length * self.width,
+                    access = mmap.ACCESS_READ)
+            finally:
+                f.close()
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        if i < 0 or i >= self.length:
+            raise IndexError(i)
+        return self.format.unpack_from(self.map, i * self.width)[0]
+
+    def slice(self, first, last):
+        """
+        Rows first up to last, copied out as an array.
+        """
+        values = array(self.typecode)
+        if last > first:
+            values.fromstring(self.map[first * self.width:last * self.width])
+        return values
+
+    def close(self):
+        if self.map:
+            self.map.close()
+
+
+class ReadingStore(object):
+    """
+    The column files of one run, in their own folder.
+    """
+
+    def __init__(self, folder, sync = False):
+        self.folder = folder
+        self.sync = sync
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        self.recover()
+
+        self.files = {}
+        for name, typecode in columns + index_columns:
+            self.files[name] = open(self.filename(name), 'ab')
+
+    def filename(self, name):
+        return os.path.join(self.folder, name + '.col')
+
+    def sizes(self, names):
+        sizes = []
+        for name, typecode in names:
+            try:
+                size = os.path.getsize(self.filename(name))
+            except OSError:
+                size = 0
+            sizes.append(size / array(typecode).itemsize)
+        return sizes
+
+    def truncate(self, names, length):
+        for name, typecode in names:
+            f = open(self.filename(name), 'ab')
+            try:
+                f.truncate(length * array(typecode).itemsize)
+            finally:
+                f.close()
+
+    def recover(self):
+        """
+        Cuts off anything after the last measurement that was stored
+        completely.
+        """
+        rows = min(self.sizes(columns))
+        entries = min(self.sizes(index_columns))
+        if entries:
+            index_rows = Column(self.filename('index_rows'), 'I')
+            try:
+                while entries and index_rows[entries - 1] > rows:
+                    entries -= 1
+                rows = index_rows[entries - 1] if entries else 0
+            finally:
+                index_rows.close()
+        else:
+            rows = 0
+
+        self.truncate(columns, rows)
+        self.truncate(index_columns, entries)
+        self.rows = rows
+
+    def append(self, timestamp, frame_set, rejected = None):
+        """
+        Stores every frame of frame_set, whose CRCs passed, and of rejected,
+        frames whose CRCs failed, as readings taken at timestamp.  The
+        rejected ones are stored as they came, with CRC_OK clear.
+        """
+        values = {}
+        for name, typecode in columns:
+            values[name] = array(typecode)
+        for frames, crc_flag in [(frame_set, CRC_OK), (rejected or '', 0)]:
+            for frame in decode_frames(frames):
+                flags = crc_flag
+                if frame[1] >= 16 * frame[2]:
+                    flags |= ALARM_HIGH
+                if frame[1] <= 16 * frame[3]:
+                    flags |= ALARM_LOW
+                for name, value in [('time', timestamp), ('number',
+                        frame[6]), ('temperature', frame[1]), ('upper_alarm',
+                        frame[2]), ('lower_alarm', frame[3]),
+                        ('configuration', frame[4]), ('crc', frame[7]),
+                        ('flags', flags)]:
+                    values[name].append(value)
+
+        for name, typecode in columns:
+            values[name].tofile(self.files[name])
+        self.flush([name for name, typecode in columns])
+
+        # the index entry last, once the readings are in
+        self.rows += len(values['time'])
+        array('I', [timestamp]).tofile(self.files['index_time'])
+        array('I', [self.rows]).tofile(self.files['index_rows'])
+        self.flush(['index_time', 'index_rows'])
+
+    def flush(self, names):
+        for name in names:
+            self.files[name].flush()
+            if self.sync:
+                os.fsync(self.files[name].fileno())
+
+    def row_range(self, start, end):
+        """
+        First row and the row after the last of the readings taken from
+        start to end, both included.
+        """
+        index_time = Column(self.filename('index_time'), 'I')
+        index_rows = Column(self.filename('index_rows'), 'I')
+        try:
+            first = bisect.bisect_left(index_time, start)
+            last = bisect.bisect_right(index_time, end)
+            first_row = index_rows[first - 1] if first else 0
+            last_row = index_rows[last - 1] if last else 0
+        finally:
+            index_time.close()
+            index_rows.close()
+        return first_row, max(first_row, last_row)
+
+    def readings(self, start, end, names = None):
+        """
+        The readings taken from start to end, both included, as a
+        dictionary of column name to array.  names picks the columns,
+        default all of them.
+        """
+        first, last = self.row_range(start, end)
+        result = {}
+        for name, typecode in columns:
+            if names and name not in names:
+                continue
+            column = Column(self.filename(name), typecode)
+            try:
+                result[name] = column.slice(first, last)
+            finally:
+                column.close()
+        return result
+
+    def close(self):
+        for f in self.files.values():
+            if self.sync:
+                os.fsync(f.fileno())
+            f.close()
+        self.files = {}
+
+#---------------------------------------------------------------------
+
+# Test Code
+
+if __name__ == '__main__':
+
+    import tempfile
+    import time
+    from DS18B20Frames_V1R1 import build_frame
+
+    folder = os.path.join(tempfile.mkdtemp(), "run_readings")
+    store = ReadingStore(folder)
+
+    # A week of one minute measurements from 4 sensors
+    start = 1439035200
+    frame_sets = []
+    for number in range(4):
+        frame_sets.append(build_frame(4, number + 1, 20.0 + number,
+            "Sensor %d" % number, 12, 22, 0))
+    frame_set = bytearray().join(frame_sets)
+    begin = time.time()
+    for i in range(7 * 1440):
+        store.append(start + 60 * i, frame_set)
+    print "stored %d readings in %.2f s" % (store.rows, time.time() - begin)
+
+    begin = time.time()
+    values = store.readings(start + 86400, start + 86400 + 3599)
+    print "one hour: %d readings in %.2f ms" % (len(values['time']),
+        1000 * (time.time() - begin))
+    print "sensor numbers: ", sorted(set(values['number']))
+    print "sensor 4 raw temperature: ", values['temperature'][3]
+    print "high alarms: ", len([f for f in values['flags'] if f & ALARM_HIGH])
+
+    # A measurement with a frame that failed its CRC
+    bad = bytearray(frame_sets[2])
+    bad[2] ^= 0x10
+    store.append(start + 7 * 1440 * 60, bytearray().join(frame_sets[:2] +
+        frame_sets[3:]), bad)
+    values = store.readings(start + 7 * 1440 * 60, start + 7 * 1440 * 60)
+    print "CRC failed: ", [(number, flags & CRC_OK) for number, flags in
+        zip(values['number'], values['flags'])]
+    store.close()
+
+    # The power goes off in the middle of a measurement
+    f = open(os.path.join(folder, "time.col"), 'ab')
+    f.write("\x01\x02\x03")
+    f.close()
+    store = ReadingStore(folder)
+    print "after recovery: %d readings" % store.rows
+    print "last hour: %d readings" % len(store.readings(start + 7 * 86400 -
+        3600, start + 7 * 86400)['time'])
+    store.close()
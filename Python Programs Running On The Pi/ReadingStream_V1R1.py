@@ -0,0 +1,158 @@
+#!/usr/bin/python
+
+"""
+Hands every measurement to any number of listeners as it is made, for
+wall displays, an LCD or anything else that wants the readings live
+without reading files.
+
+Each listener has a queue of its own that holds queue_size messages.
+publish() only ever adds to the queues, so it never waits for a listener.
+A listener that falls so far behind that its queue is full is dropped,
+and can connect again to pick up from the newest measurement.
+
+Messages are server-sent events, the format browsers read with
+EventSource:
+
+    event: reading
+    id: 61
+    data: {"f":[68.6,70.4],"m":61,"t":1439038860}
+
+t is the measurement time, m the measurement number and f the temperature
+of each sensor, by slot.  The sensors event, sent first to every new
+listener, gives each slot's sensor number and name.
+"""
+
+import Queue
+import json
+import threading
+
+
+def server_sent_event(event, data, id = None):
+    """
+    One message, data as compact JSON.
+    """
+    lines = ["event: %s" % event]
+    if id is not None:
+        lines.append("id: %s" % id)
+    lines.append("data: %s" % json.dumps(data, separators = (',', ':'),
+        sort_keys = True))
+    return "\n".join(lines) + "\n\n"
+
+
+class Listener(object):
+    """
+    One listener's queue.
+    """
+
+    def __init__(self, queue_size):
+        self.queue = Queue.Queue(queue_size)
+        self.dropped = False
+
+    def next_message(self, timeout):
+        """
+        The next message, or None if there was none for timeout seconds.
+        Once the listener has been dropped, None when its queue is empty.
+        """
+        try:
+            return self.queue.get(not self.dropped, timeout)
+        except Queue.Empty:
+            return None
+
+
+class ReadingStream(object):
+    """
+    The listeners of one run.
+    """
+
+    def __init__(self, queue_size = 32):
+        self.queue_size = queue_size
+        self.lock = threading.Lock()
+        self.listeners = set()
+        self.published = 0
+        self.dropped = 0      # listeners too slow to keep
+
+    def subscribe(self, first = None):
+        """
+        A new listener, with the message first waiting for it.
+        """
+        listener = Listener(self.queue_size)
+        if first:
+            listener.queue.put_nowait(first)
+        self.lock.acquire()
+        try:
+            self.listeners.add(listener)
+        finally:
+            self.lock.release()
+        return listener
+
+    def unsubscribe(self, listener):
+        self.lock.acquire()
+        try:
+            self.listeners.discard(listener)
+        finally:
+            self.lock.release()
+
+    def publish(self, message):
+        """
+        Adds a message to every listener's queue.  Never waits.
+        """
+        self.lock.acquire()
+        try:
+            self.published += 1
+            for listener in list(self.listeners):
+                try:
+                    listener.queue.put_nowait(message)
+                except Queue.Full:
+                    listener.dropped = True
+                    self.listeners.discard(listener)
+                    self.dropped += 1
+        finally:
+            self.lock.release()
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            for listener in self.listeners:
+                listener.dropped = True
+            self.listeners.clear()
+        finally:
+            self.lock.release()
+
+#---------------------------------------------------------------------
+
+# Test Code
+
+if __name__ == '__main__':
+
+    import time
+
+    stream = ReadingStream(queue_size = 4)
+    hello = server_sent_event('sensors', [{'number': 3, 'name': 'Box: 3'}])
+    fast = stream.subscribe(hello)
+    slow = stream.subscribe(hello)
+
+    received = []
+    def read_fast():
+        while True:
+            message = fast.next_message(1.0)
+            if message is None:
+                return
+            received.append(message)
+    reader = threading.Thread(target = read_fast)
+    reader.start()
+
+    # the slow listener never reads
+    longest = 0
+    for measurement in range(1, 11):
+        published = time.time()
+        stream.publish(server_sent_event('reading', {'t': 1439038800 +
+            60 * measurement, 'm': measurement, 'f': [68.5]}, measurement))
+        longest = max(longest, time.time() - published)
+        time.sleep(0.01)
+    print "10 measurements published, longest %.4f s" % longest
+    reader.join()
+    print "fast listener got %d messages, dropped: %s" % (len(received),
+        fast.dropped)
+    print "slow listener dropped: %s, listeners left: %d" % (slow.dropped,
+        len(stream.listeners))
+    print received[0] + received[-1],
@@ -0,0 +1,272 @@
+#!/usr/bin/python
+
+"""
+Writes the results text file, and a companion file of the same results for
+other programs to read.
+
+The results file used to be opened and closed three or four times every
+measurement.  Here it is opened once and what is written collects in
+memory.  It goes to the file every flush_cycles measurements or
+flush_seconds seconds, whichever comes first, and always when the program
+closes the writer at the end of the run.  With sync the SD card is told to
+store it right away too.  on_flush, if given, is called with the number of
+the last measurement each time the results have gone to the files; a
+program saves its checkpoint for --resume there, so the checkpoint only
+ever counts measurements that are in the files.  The text is exactly what
+the programs have always written.
+
+The companion has one row per measurement: the measurement time in
+seconds since 1970 (the time in the RRD files), the measurement number and
+the temperature of each sensor in degrees F, empty if the measurement
+failed.  It is a CSV file, filename.csv, or with companion = 'jsonl' a
+file of one JSON object per line, filename.jsonl.  When a run is resumed,
+rows_after() reads the measurements back for the RRD files.
+"""
+
+import csv
+import json
+import os
+import time
+
+
+class ResultsWriter(object):
+    """
+    The results file and its companion for one run.
+    """
+
+    def __init__(self, filename, companion = 'csv', flush_cycles = 10,
+            flush_seconds = 300, sync = False, on_flush = None):
+        self.filename = filename + '.txt'
+        self.companion = companion
+        self.flush_cycles = flush_cycles
+        self.flush_seconds = flush_seconds
+        self.sync = sync
+        self.on_flush = on_flush
+
+        self.text = []          # waiting to be written
+        self.rows = []
+        self.cycles = 0         # measurements since the last flush
+        self.last_flush = time.time()
+        self.registry = None
+        self.timestamp = None   # of the measurement being written
+        self.number = None
+
+        self.f = None
+        self.companion_f = None
+        self.csv_writer = None
+        if companion:
+            self.companion_name = filename + '.' + companion
+        else:
+            self.companion_name = None
+
+    def open(self, mode):
+        try:
+            self.f = open(self.filename, mode)
+            if self.companion_name:
+                self.companion_f = open(self.companion_name, mode)
+                if self.companion == 'csv':
+                    self.csv_writer = csv.writer(self.companion_f)
+        except(IOError):
+            print '\nCould not open the file\n'
+
+    def header(self, title, registry, comment):
+        """
+        Starts a new results file with the title, the sensors and the
+        comment.
+        """
+        self.registry = registry
+        self.open('w')
+
+        self.write("Graph Title: %s \n\n" % title)
+        for sensor in registry:
+            self.write("Measuring: %s, Sensor number: %d, Resolution: %d bits\n"
+                % (sensor.name, sensor.number, sensor.resolution))
+        if comment != "":
+            self.write("\nGraph Comments: %s \n" % comment)
+        self.write("\n\n")
+
+        if self.companion == 'csv':
+            self.rows.append(['time', 'measurement'] + [
+                sensor.name.replace("\\:", ":") for sensor in registry])
+        self.flush()
+
+    def resume(self, registry):
+        """
+        Instead of header() when a run is resumed.  The results are added
+        to the end of the run's files.
+        """
+        self.registry = registry
+        self.open('a')
+
+    def write(self, text):
+        self.text.append(text)
+
+    def measurement(self, measurement, to_go, timenow, timestamp):
+        """
+        Starts the results of one measurement.  timenow is the datetime
+        shown in the results file, timestamp the time stored in the RRD
+        files.
+        """
+        self.number = measurement
+        self.timestamp = timestamp
+        self.write("Measurement: %d. %d to go\n" % (measurement, to_go))
+        self.write(timenow.strftime("%A, %B %d, %I:%M:%S %p:\n"))
+
+    def temperatures(self, temp_f):
+        """
+        The temperature of each sensor, by slot, for this measurement.
+        """
+        for sensor in self.registry:
+            self.write((" The %s sensor temperature is %3.1f")
+                % (sensor.name, temp_f[sensor.slot]) + " degF\n")
+        self.write("\n")
+        self.add_row([temp_f[sensor.slot] for sensor in self.registry])
+
+    def failed(self):
+        self.write(" Failed to retrieve data\n\n")
+        self.add_row([None] * len(self.registry))
+
+    def add_row(self, values):
+        if self.companion == 'jsonl':
+            temperatures = {}
+            for sensor, value in zip(self.registry, values):
+                temperatures[str(sensor.number)] = value
+            self.rows.append(json.dumps({'time': self.timestamp,
+                'measurement': self.number, 'temperatures': temperatures},
+                sort_keys = True) + "\n")
+        elif self.companion == 'csv':
+            self.rows.append([self.timestamp, self.number] + [
+                "" if value is None else "%3.1f" % value for value in values])
+
+    def end_cycle(self):
+        """
+        Called after each measurement.  Writes to the files when it is
+        time to.
+        """
+        self.cycles += 1
+        if (self.cycles >= self.flush_cycles or
+                time.time() - self.last_flush >= self.flush_seconds):
+            self.flush()
+
+    def flush(self, sync = False):
+        """
+        Writes everything waiting to the files.  If that fails it is kept
+        to try again next time.  sync stores it on the SD card right away
+        even if the writer was not made with sync.
+        """
+        self.cycles = 0
+        self.last_flush = time.time()
+        if not self.f:      # could not open it, nowhere to keep the results
+            self.text = []
+            self.rows = []
+            return
+        try:
+            self.f.write("".join(self.text))
+            self.f.flush()
+            self.text = []
+            if self.companion_f:
+                if self.csv_writer:
+                    self.csv_writer.writerows(self.rows)
+                else:
+                    self.companion_f.write("".join(self.rows))
+                self.companion_f.flush()
+                self.rows = []
+            if self.sync or sync:
+                os.fsync(self.f.fileno())
+                if self.companion_f:
+                    os.fsync(self.companion_f.fileno())
+        except(IOError):
+            print '\nCould not write to the file\n'
+            return
+        if self.on_flush and self.number is not None:
+            self.on_flush(self.number)
+
+    def rows_after(self, after):
+        """
+        Called when a run is resumed, after resume().  The measurements in
+        the companion file made after the time after, as (time, temperature
+        of each sensor by slot), to a tenth of a degree.  Failed ones are
+        left out.
+        """
+        rows = []
+        try:
+            f = open(self.companion_name or '')
+        except IOError:
+            return rows
+        try:
+            if self.companion == 'csv':
+                lines = csv.reader(f)
+                next(lines, None)   # the sensor names
+                for line in lines:
+                    try:
+                        rows.append((int(line[0]), [float(value) if value
+                            else None for value in line[2:]]))
+                    except (ValueError, IndexError):
+                        pass        # the last line may be cut short
+            else:
+                for line in f:
+                    try:
+                        row = json.loads(line)
+                    except ValueError:
+                        continue
+                    rows.append((row['time'], [row['temperatures'].get(
+                        str(sensor.number)) for sensor in self.registry]))
+        finally:
+            f.close()
+
+        by_slot = []
+        for timestamp, values in rows:
+            if timestamp <= after or values.count(None) == len(values):
+                continue
+            temp_f = [None] * len(self.registry)
+            for sensor, value in zip(self.registry, values):
+                temp_f[sensor.slot] = value
+            by_slot.append((timestamp, temp_f))
+        return by_slot
+
+    def close(self):
+        self.flush()
+        for f in [self.f, self.companion_f]:
+            if f:
+                f.close()
+        self.f = None
+        self.companion_f = None
+
+#---------------------------------------------------------------------
+
+# Test Code
+
+if __name__ == '__main__':
+
+    import tempfile
+    from datetime import datetime
+    from SensorRegistry_V1R1 import SensorRegistry
+
+    registry = SensorRegistry()
+    for number in [2, 5, 7]:
+        registry.add(number, "Box\\:%d" % number, 12)
+
+    folder = tempfile.mkdtemp()
+    flushed = []
+    for companion in ['csv', 'jsonl']:
+        results = ResultsWriter(os.path.join(folder, "run"), companion, 3,
+            on_flush = flushed.append)
+        results.header("Test Title", registry, "a comment")
+        for measurement in range(1, 6):
+            results.measurement(measurement, 5 - measurement,
+                datetime(2015, 8, 8, 12, measurement), 1439035200 +
+                60 * measurement)
+            if measurement == 4:
+                results.failed()
+            else:
+                results.temperatures([70.0 + measurement + slot
+                    for slot in range(3)])
+            results.end_cycle()
+            print "measurement %d, waiting: %d lines" % (measurement,
+                len(results.text))
+        results.write("Total Number of Measurements Per Device: 5\n")
+        results.close()
+        print open(os.path.join(folder, "run." + companion)).read()
+        print "after measurement 2: ", results.rows_after(1439035200 + 120)
+    print "flushed after measurements: ", flushed
+    print open(os.path.join(folder, "run.txt")).read()
@@ -0,0 +1,180 @@
+#!/usr/bin/python
+
+"""
+How long to wait before trying again when getting the data fails.
+
+get_measurement() used to sleep 1.2 seconds for every sensor between its
+three tries, and after the last one as well.  With 50 sensors a bad
+measurement held up the program for three minutes, longer than the
+shortest measurement interval, so the next measurement was missed.
+get_stored_data() waited 10 seconds between tries, and after its last one
+too.
+
+Here the wait starts short and doubles with each retry, up to longest.
+Each wait is cut by a random part of up to jitter of it, so retries do not
+fall into step with the enclosure's own timing.  A measurement is given
+the time left before the next one is due.  When the next wait and a try as
+long as the longest so far will not fit in that, the policy gives up, so a
+bad measurement never makes the next one late.
+
+Use it like this:
+
+    retry.start(seconds)
+    while not got_the_data():
+        if not retry.wait():
+            break   # out of tries or out of time
+    retry.finish()
+
+The retries each measurement needed and the seconds they cost, waiting and
+trying again, are counted for summary().
+"""
+
+import random
+import time
+from MeasurementScheduler_V1R1 import monotonic
+
+
+class RetryPolicy(object):
+    """
+    Exponential backoff with jitter, within a time budget.
+    """
+
+    def __init__(self, tries = 3, first = 0.5, longest = 10.0, factor = 2.0,
+            jitter = 0.5):
+        self.tries = tries
+        self.first = first      # seconds before the first retry
+        self.longest = longest  # seconds, no wait is longer
+        self.factor = factor
+        self.jitter = jitter
+
+        self.budget_end = None  # monotonic time the budget runs out
+        self.tried = 0          # tries this cycle
+        self.try_started = None
+        self.longest_try = 0.0
+        self.first_retry = None # monotonic time of the first wait
+        self.last = (0, 0.0)    # (retries, seconds) of the last cycle
+
+        self.cycles = 0
+        self.retried = []       # (retries, seconds) of each cycle that
+                                # retried
+        self.out_of_time = 0    # cycles given up for lack of time
+
+    def start(self, budget = None):
+        """
+        Called before the first try.  budget is the seconds there are for
+        all of them, None for no limit.
+        """
+        now = monotonic()
+        self.budget_end = None if budget is None else now + budget
+        self.tried = 1
+        self.try_started = now
+        self.longest_try = 0.0
+        self.first_retry = None
+
+    def delay(self, retry):
+        """
+        Seconds to wait before retry number retry, 1 for the first.
+        """
+        delay = min(self.first * self.factor ** (retry - 1), self.longest)
+        return delay * (1 - self.jitter * random.random())
+
+    def time_left(self):
+        if self.budget_end is None:
+            return None
+        return self.budget_end - monotonic()
+
+    def timeout(self, seconds):
+        """
+        seconds, or less if the budget has less left, for a try to wait
+        for its data.
+        """
+        left = self.time_left()
+        if left is None:
+            return seconds
+        return max(0.1, min(seconds, left))
+
+    def wait(self):
+        """
+        Called after a try failed.  Sleeps before the next try and returns
+        True, or returns False at once if there are no tries or no time
+        left.
+        """
+        now = monotonic()
+        self.longest_try = max(self.longest_try, now - self.try_started)
+        if self.tried >= self.tries:
+            return False
+        delay = self.delay(self.tried)
+        left = self.time_left()
+        if left is not None and delay + self.longest_try > left:
+            self.out_of_time += 1
+            return False
+
+        if self.first_retry is None:
+            self.first_retry = now
+        time.sleep(delay)
+        self.tried += 1
+        self.try_started = monotonic()
+        return True
+
+    def finish(self):
+        """
+        Called after the last try.  Returns the retries and the seconds
+        they cost.
+        """
+        self.cycles += 1
+        if self.first_retry is None:
+            self.last = (0, 0.0)
+        else:
+            self.last = (self.tried - 1, monotonic() - self.first_retry)
+            self.retried.append(self.last)
+        return self.last
+
+    def summary(self, what):
+        """
+        Lines for the terminal at the end of the run.
+        """
+        if not self.retried:
+            return ["%s Retried: none" % what]
+        retries = [count for count, seconds in self.retried]
+        seconds = [seconds for count, seconds in self.retried]
+        lines = ["%s Retried: %d of %d, %d retries, most %d at once" % (
+            what, len(self.retried), self.cycles, sum(retries),
+            max(retries))]
+        lines.append("Retries Cost: %.1f s in all, longest %.1f s" % (
+            sum(seconds), max(seconds)))
+        if self.out_of_time:
+            lines.append("Retries Given Up For Lack Of Time: %d" %
+                self.out_of_time)
+        return lines
+
+#---------------------------------------------------------------------
+
+# Test Code
+
+if __name__ == '__main__':
+
+    retry = RetryPolicy(tries = 5, first = 0.05, longest = 0.3)
+    print "waits:", ["%.3f" % retry.delay(n) for n in range(1, 7)]
+
+    # a try that fails twice, then works
+    outcomes = [False, False, True]
+    retry.start(2.0)
+    while not outcomes.pop(0):
+        if not retry.wait():
+            break
+    print "retries %d, cost %.3f s" % retry.finish()
+
+    # tries of 0.2 s that never work, with 0.5 s to the next measurement
+    retry.start(0.5)
+    begin = monotonic()
+    while True:
+        time.sleep(0.2)
+        if not retry.wait():
+            break
+    print "gave up after %.3f s of a 0.5 s budget, retries %d" % (
+        monotonic() - begin, retry.finish()[0])
+
+    retry.start()
+    retry.finish()
+    for line in retry.summary("Measurements"):
+        print line
@@ -0,0 +1,138 @@
+#!/usr/bin/python
+
+"""
+Saves what is needed to continue a measurement run if the program stops,
+so a run can be resumed after a reboot or crash instead of started over.
+
+The checkpoint is a small JSON file next to the run's other files,
+filename_checkpoint.json, so runs with different file names each have
+their own.  It is written before the first measurement and each time the
+results go to their files, and counts the measurements in the results file
+as made.  It holds the settings from the GUI, the sensors the run started
+with, the start time, the time and number of the next measurement, how
+many are left, the error counts and the newest measurement in the RRD
+files.  It is written to a new file that then replaces the old one, so
+there is always one complete checkpoint even if the power goes off while
+it is written.
+
+When a run is resumed it keeps to its original schedule.  Measurements
+that were due while the program was stopped are counted as made, and the
+RRD files have nothing for them, so they show as a gap in the graph.
+"""
+
+import json
+import os
+
+
+def checkpoint_file(filename):
+    """
+    The checkpoint of the run whose files start with filename.
+    """
+    return filename + "_checkpoint.json"
+
+
+def manifest(registry):
+    """
+    The sensors of a run: [sensor number, name, resolution] of each, in
+    slot order.  Lists, so it compares equal to one read back from JSON.
+    The names are the 12 bytes the enclosure sent, which need not be
+    UTF-8, so each byte is kept as one character.
+    """
+    return [[sensor.number, sensor.name.decode('latin-1'), sensor.resolution]
+        for sensor in registry]
+
+
+def save_checkpoint(filename, state):
+    """
+    Returns False, leaving the last checkpoint as it was, if state will
+    not go into JSON.
+    """
+    try:
+        text = json.dumps(state, sort_keys = True)
+    except (TypeError, ValueError), e:
+        print "\nCould not save the checkpoint: %s\n" % e
+        return False
+    temporary = filename + ".new"
+    f = open(temporary, 'w')
+    try:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    finally:
+        f.close()
+    os.rename(temporary, filename)
+    return True
+
+
+def load_checkpoint(filename):
+    """
+    The checkpoint, or None if there is none.
+    """
+    try:
+        f = open(filename)
+    except IOError:
+        return None
+    try:
+        try:
+            return json.load(f)
+        except ValueError:
+            return None
+    finally:
+        f.close()
+
+
+def remove_checkpoint(filename):
+    if os.path.exists(filename):
+        os.remove(filename)
+
+
+def catch_up(checkpoint, now):
+    """
+    Returns the time of the next measurement on the run's schedule that is
+    still to come, its measurement number, how many measurements are left
+    counting it, and how many were missed while the program was stopped.
+    """
+    interval = checkpoint['interval']
+    next_meas_time = checkpoint['next_meas_time']
+    measurement = checkpoint['measurement']
+    left = checkpoint['measurements_left']
+
+    missed = 0
+    if now > next_meas_time:
+        missed = min(int((now - next_meas_time) / interval) + 1, left)
+    return (next_meas_time + missed * interval, measurement + missed,
+        left - missed, missed)
+
+#---------------------------------------------------------------------
+
+# Test Code
+
+if __name__ == '__main__':
+
+    import tempfile
+    from SensorRegistry_V1R1 import SensorRegistry
+
+    registry = SensorRegistry()
+    for number in [3, 8]:
+        registry.add(number, "Box\\:%d" % number, 11)
+    registry.add(9, "Caf\xe9 \xff\n", 12)     # not UTF-8
+
+    filename = checkpoint_file(os.path.join(tempfile.mkdtemp(), "test"))
+    print "checkpoint before any: ", load_checkpoint(filename)
+
+    save_checkpoint(filename, {'sensors': manifest(registry),
+        'interval': 60, 'next_meas_time': 1439035260, 'measurement': 11,
+        'measurements_left': 90, 'errors': [0, 1, 0, [[None, 2], [3, 1]]]})
+    checkpoint = load_checkpoint(filename)
+    print "same sensors: ", checkpoint['sensors'] == manifest(registry)
+    print "crc errors: ", dict(checkpoint['errors'][3])
+    saved = save_checkpoint(filename, {'sensors': set()})
+    print "saved with a set: %s, interval kept: %d" % (saved,
+        load_checkpoint(filename)['interval'])
+
+    # Stopped for 10 and a half minutes
+    print "next time, number, left, missed: ", catch_up(checkpoint,
+        1439035260 + 630)
+    print "all missed: ", catch_up(checkpoint, 1439035260 + 86400)
+    remove_checkpoint(filename)
+    print "checkpoint left: ", os.path.exists(filename)
@@ -0,0 +1,162 @@
+#!/usr/bin/python
+
+"""
+Keeps everything we know about each sensor in one record, found by its
+sensor number.
+
+The sensor number is byte 18 of the sensor's frame.  The sensors are put in
+slots in the order of their sensor numbers, the order they are listed in
+the results file and on the graph.  Each record holds the slot, name,
+resolution, RRD file and graph style, so a frame leads straight to
+everything needed to store and graph its temperature with one dictionary
+lookup.
+
+There are colors for as many sensors as the ATmega328P EEPROM can hold,
+50.  The first 12 are the colors we have always used.
+"""
+
+import colorsys
+
+# Graph colors for the first 12 sensors:
+base_colors = [
+    '#FF0000',  # Red
+    '#0000FF',  # Blue
+    '#00FF00',  # Green
+    '#00FFFF',  # Cyan
+    '#FFFF00',  # Yellow
+    '#FF00FF',  # Magenta
+    '#FF8000',  # Orange
+    '#804000',  # Brown
+    '#408080',  # Gray Green
+    '#FF80FF',  # Pink
+    '#408040',  # Dark Green
+    '#0040C0',  # Dark Blue
+]
+
+
+def graph_color(slot):
+    """
+    Color for the sensor in this slot.  After the first 12, hues are spread
+    around the color wheel by the golden angle so neighbours never look
+    alike, with the brightness stepped so repeats of a hue still differ.
+    """
+    if slot < len(base_colors):
+        return base_colors[slot]
+    n = slot - len(base_colors)
+    hue = (0.07 + n * 0.618034) % 1.0
+    value = [0.95, 0.7, 0.5][n % 3]
+    red, green, blue = colorsys.hsv_to_rgb(hue, 0.85, value)
+    return '#%02X%02X%02X' % (int(255 * red), int(255 * green),
+        int(255 * blue))
+
+
+def get_description(frame):
+    """
+    The description in bytes 6 through 17 of a frame, up to the line feed
+    that ends it.  Colons are escaped for rrdtool.
+    """
+    description = ""
+    for byte in bytearray(frame[6:18]):
+        if byte == 10: # found end of line
+            break
+        description += chr(byte)
+    if not description:
+        description = "No Descrip."
+
+    # escape colons in the description
+    return description.replace(":", "\\:")
+
+
+class Sensor(object):
+    """
+    One sensor.  Only these attributes, to keep 50 of them small.
+    """
+    __slots__ = ['slot', 'number', 'name', 'resolution', 'color',
+        'conversion', 'ds_name', 'rrdfile', 'device', 'graph_def',
+        'graph_line', 'graph_aver', 'graph_val']
+
+    def __init__(self, slot, number, name, resolution):
+        self.slot = slot                # position in results and graphs
+        self.number = number            # given by sending unit
+        self.name = name                # description entered at sending unit
+        self.resolution = resolution    # 9 - 12 bits
+        self.color = graph_color(slot)
+        self.ds_name = "Sensor" + str(slot)
+        self.conversion = None          # these are filled in by the program
+        self.rrdfile = None             #   when it loads the calibration,
+        self.device = None              #   sets up the RRD files and
+        self.graph_def = None           #   graph
+        self.graph_line = None
+        self.graph_aver = None
+        self.graph_val = None
+
+
+class SensorRegistry(object):
+    """
+    All the sensors, in slot order, and a dictionary to find them by sensor
+    number.
+    """
+
+    def __init__(self):
+        self.sensors = []
+        self.by_number = {}
+
+    def __len__(self):
+        return len(self.sensors)
+
+    def __iter__(self):
+        return iter(self.sensors)
+
+    def __getitem__(self, slot):
+        return self.sensors[slot]
+
+    def add(self, number, name, resolution):
+        sensor = Sensor(len(self.sensors), number, name, resolution)
+        self.sensors.append(sensor)
+        self.by_number[number] = sensor
+        return sensor
+
+    def lookup(self, number):
+        """
+        The sensor with this sensor number, or None.
+        """
+        return self.by_number.get(number)
+
+    def numbers(self):
+        return [sensor.number for sensor in self.sensors]
+
+    def from_frames(self, frame_set, frame_length = 20):
+        """
+        Adds every sensor in a frame set, in the order of their sensor
+        numbers.  Each frame is looked at once.
+        """
+        frames = {}
+        for j in range(len(frame_set) / frame_length):
+            frame = frame_set[frame_length * j:frame_length * (j + 1)]
+            frames[frame[18]] = frame
+
+        for number in sorted(frames.keys()):
+            frame = frames[number]
+            self.add(number, get_description(frame), (frame[5] >> 5) + 9)
+        return self
+
+#---------------------------------------------------------------------
+
+# Test Code
+
+if __name__ == '__main__':
+
+    from DS18B20Frames_V1R1 import build_frame
+
+    frame_set = bytearray()
+    for number in [40, 3, 17, 9]:
+        frame_set += build_frame(4, number, 21.5, "Box:%d" % number, 10)
+    frame_set += build_frame(4, 1, 21.5, "", 12)
+
+    sensors = SensorRegistry().from_frames(frame_set)
+    for sensor in sensors:
+        print sensor.slot, sensor.number, sensor.name, sensor.resolution, \
+            sensor.color
+    print "sensor 17 is in slot ", sensors.lookup(17).slot
+    print "50 colors, all different: ", len(set([graph_color(slot)
+        for slot in range(50)])) == 50
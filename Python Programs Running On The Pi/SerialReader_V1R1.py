@@ -0,0 +1,271 @@
+#!/usr/bin/python
+
+"""
+Reader thread for the serial port between the Pi and the Gertboard.
+
+The ATmega328P on the Gertboard sends the last frame set it received over
+the 434MHz link whenever the Pi writes an "s" to the serial port.  Instead of
+polling the serial port once a second, the reader thread sits in a blocking
+read and puts every byte into a ring buffer as soon as it arrives.  The
+first 20 bytes whose CRC passes mark the start of the frame set.  Byte 0 of
+that frame tells us how many frames make up the frame set, so we know
+exactly when the last byte is in.  The complete frame set goes to the main
+program through a queue.
+
+A first frame with a bad CRC followed by a good frame is still the start of
+the frame set, so the main program rejects just that frame.  If the bytes
+stop coming part way through a frame set, the whole frames that did arrive
+are handed over after idle_time, instead of the main program waiting for
+bytes that will never come.
+"""
+
+import Queue
+import threading
+import time
+from DS18B20Frames_V1R1 import crc8
+
+
+class RingBuffer(object):
+    """
+    Fixed size circular buffer of bytes.  Bytes that do not fit are
+    dropped and counted in overflows.
+    """
+
+    def __init__(self, size = 4096):
+        self.data = bytearray(size)
+        self.size = size
+        self.start = 0        # index of the oldest byte
+        self.length = 0       # bytes held
+        self.overflows = 0
+
+    def __len__(self):
+        return self.length
+
+    def write(self, chunk):
+        for byte in bytearray(chunk):
+            if self.length == self.size:
+                self.overflows += 1
+                return
+            self.data[(self.start + self.length) % self.size] = byte
+            self.length += 1
+
+    def peek(self, index):
+        return self.data[(self.start + index) % self.size]
+
+    def copy(self, index, count):
+        """
+        Returns count bytes starting index bytes from the oldest as a
+        bytearray, without removing them.
+        """
+        return bytearray(self.peek(index + i) for i in range(count))
+
+    def read(self, count):
+        """
+        Removes and returns the oldest count bytes as a bytearray.
+        """
+        end = self.start + count
+        if end <= self.size:
+            out = self.data[self.start:end]
+        else:
+            out = self.data[self.start:] + self.data[:end - self.size]
+        self.discard(count)
+        return out
+
+    def discard(self, count):
+        count = min(count, self.length)
+        self.start = (self.start + count) % self.size
+        self.length -= count
+
+    def clear(self):
+        self.start = 0
+        self.length = 0
+
+
+class SerialReader(threading.Thread):
+    """
+    Background thread that reads the serial port and hands complete frame
+    sets to the main program through the frames queue.
+
+    Call start() once at the beginning of the program.  Before asking the
+    Gertboard for data call flush() to throw away anything left over, then
+    request() to send the "s" and wait for the frame set.
+    """
+
+    def __init__(self, ser, frame_length = 20, idle_time = 0.5):
+        threading.Thread.__init__(self)
+        self.daemon = True    # do not keep the program alive on exit
+
+        self.ser = ser
+        self.ser.timeout = idle_time  # so the idle check runs that often
+        self.frame_length = frame_length
+        self.idle_time = idle_time  # seconds before a partial frame set is
+                                    # handed over as it is
+        self.buffer = RingBuffer()
+        self.lock = threading.Lock()
+        self.frames = Queue.Queue()
+        self.last_byte = 0    # time.time() of the last byte received
+
+        self.started = 0      # bytes of a frame set being received
+        self.frame_sets = 0   # complete frame sets received
+        self.short_sets = 0   # frame sets handed over with frames missing
+        self.discarded = 0    # bytes thrown away to find a frame boundary
+        self.running = True
+
+    def run(self):
+        while self.running:
+            # Blocks until at least one byte arrives or the port times out
+            in_coming = self.ser.read(max(self.ser.inWaiting(), 1))
+
+            self.lock.acquire()
+            try:
+                now = time.time()
+                if (len(self.buffer) and
+                        now - self.last_byte > self.idle_time):
+                    self.give_up()
+                if in_coming:
+                    self.last_byte = now
+                    self.buffer.write(in_coming)
+                    self.find_frame_sets()
+            finally:
+                self.lock.release()
+
+    def find_frame_sets(self):
+        """
+        Takes every complete frame set off the front of the ring buffer.
+
+        Byte 0 of every frame holds the number of sensors.  If the first
+        byte cannot be the start of a frame set, or the CRC of the frame
+        starting there fails, we drop one byte and look again.  Once the
+        first frame is good the rest of the frame set follows it.  A first
+        frame that fails is kept if the frame after it is good, its byte 0
+        giving the number of sensors, as the first frame's may be the
+        corrupted byte.  A later frame with a bad CRC stays in the frame set
+        so the main program can reject just that frame.
+        """
+        length = self.frame_length
+        while len(self.buffer):
+            sensors = self.buffer.peek(0)
+            if sensors == 0 or sensors * length > self.buffer.size:
+                self.buffer.discard(1)
+                self.discarded += 1
+                continue
+
+            if len(self.buffer) < length:
+                return      # wait for the rest of the first frame
+            if crc8(self.buffer.copy(0, length)):
+                if sensors > 1 and len(self.buffer) < 2 * length:
+                    return  # wait for the second frame to tell
+                second = self.buffer.peek(length)
+                if (sensors == 1 or second < 2 or
+                        second * length > self.buffer.size or
+                        crc8(self.buffer.copy(length, length))):
+                    self.buffer.discard(1)
+                    self.discarded += 1
+                    continue
+                sensors = second
+
+            needed = sensors * length
+            if len(self.buffer) < needed:
+                self.started = len(self.buffer)
+                return      # wait for the rest
+
+            self.started = 0
+            self.frame_sets += 1
+            self.frames.put(self.buffer.read(needed))
+
+    def give_up(self):
+        """
+        Called when no byte has come for idle_time.  Hands over the whole
+        frames of a frame set that stopped part way and throws away the
+        rest.
+        """
+        frames = self.started / self.frame_length
+        if frames:
+            self.short_sets += 1
+            self.frames.put(self.buffer.read(frames * self.frame_length))
+        self.discarded += len(self.buffer)
+        self.buffer.clear()
+        self.started = 0
+
+    def flush(self):
+        """
+        Throws away partial data and frame sets nobody asked for.
+        """
+        self.lock.acquire()
+        try:
+            self.buffer.clear()
+            self.started = 0
+            while not self.frames.empty():
+                self.frames.get_nowait()
+        finally:
+            self.lock.release()
+
+    def request(self, timeout = 10.0):
+        """
+        Sends "s" to trigger the Gertboard to transmit data, then waits up
+        to timeout seconds for the frame set.  Returns the frame set as a
+        bytearray, or an empty bytearray if none arrived.
+        """
+        self.flush()
+        self.ser.write("s")
+        try:
+            return self.frames.get(timeout = timeout)
+        except Queue.Empty:
+            return bytearray()
+
+    def stop(self):
+        self.running = False
+
+#---------------------------------------------------------------------
+
+# Test Code
+
+if __name__ == '__main__':
+
+    import os
+    import select
+    from DS18B20Frames_V1R1 import frame_ok
+
+    class FakeSerial(object):
+        """Replays a frame set in small pieces, like a slow serial port."""
+
+        def __init__(self, data):
+            self.read_fd, self.write_fd = os.pipe()
+            self.data = data
+            self.timeout = None
+
+        def inWaiting(self):
+            return 0
+
+        def read(self, size = 1):
+            if not select.select([self.read_fd], [], [], self.timeout)[0]:
+                return ""
+            return os.read(self.read_fd, size)
+
+        def write(self, text):
+            # some junk, then the frame set a few bytes at a time
+            os.write(self.write_fd, "\x00\x03\x07")
+            for i in range(0, len(self.data), 8):
+                os.write(self.write_fd, str(self.data[i:i + 8]))
+                time.sleep(0.002)
+
+    frames = bytearray()
+    for number in range(4):
+        frame = bytearray([4, 80, 1, 75, 70, 127])
+        frame += bytearray("Test Sensor\n") + bytearray([number])
+        frames += frame + bytearray([crc8(frame)])
+
+    for case, data in [("good", frames),
+            ("frame 0 corrupted", frames[:1] + "\x55" + frames[2:]),
+            ("frame 2 corrupted", frames[:41] + "\x55" + frames[42:]),
+            ("last frame lost", frames[:60])]:
+        reader = SerialReader(FakeSerial(data))
+        reader.start()
+        start = time.time()
+        frame_set = reader.request(timeout = 5.0)
+        print "%s: received %d bytes in %.3f seconds, frames ok: %s" % (
+            case, len(frame_set), time.time() - start, [frame_ok(frame_set,
+            j) for j in range(len(frame_set) / 20)])
+        print "  matches: %s, bytes discarded: %d" % (frame_set == data,
+            reader.discarded)
+        reader.stop()
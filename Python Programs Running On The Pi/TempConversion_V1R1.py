@@ -0,0 +1,179 @@
+#!/usr/bin/python
+
+"""
+Converts raw DS18B20 temperatures to degrees C, F and K by table lookup,
+with each sensor's calibration applied.
+
+The raw temperature is the signed 16 bit value from bytes 1 and 2 of the
+frame, in sixteenths of a degree C.  At less than 12 bits resolution the
+lowest bits mean nothing and are masked off, 3 bits at 9 bit resolution.
+The DS18B20 only measures -55 to +125 degrees C, so a table covers just
+those 2881 raw values.  Everything is worked out once at startup; a reading
+is then one list index.  Sensors with the same resolution and calibration
+share a table.
+
+The calibration factors are the ones Calibrate_Sensor_V1R1 stores in the
+ATmega328P EEPROM: the error at 0 degrees C and at 100 degrees C, each a
+signed byte in sixteenths of a degree.  They are corrected for the way
+apply_calibration() in DS18B20_Suite_V3R1 does it.  The Pi cannot read the
+EEPROM, so the factors are kept in a text file, one sensor per line:
+
+    sensor_number  low_factor  high_factor
+
+with the factors as the EEPROM byte values 0 - 255, the way
+Devices_In_EEPROM reports them.  Lines starting with # are ignored.
+"""
+
+from array import array
+
+raw_min = -55 * 16      # lowest temperature the DS18B20 measures
+raw_max = 125 * 16      # highest
+
+calibration_file = "/home/pi/Documents/PythonProjects/TempProbe/calibration.txt"
+
+
+def signed_byte(value):
+    if value > 127:
+        value -= 256
+    return value
+
+
+def load_calibration(filename = calibration_file):
+    """
+    Reads the calibration file.  Returns a dictionary of sensor number to
+    (low correction, high correction) in degrees C.  A missing file means
+    no sensor is calibrated.
+    """
+    calibration = {}
+    try:
+        f = open(filename)
+    except IOError:
+        return calibration
+    try:
+        for line in f:
+            fields = line.split("#")[0].split()
+            if len(fields) != 3:
+                continue
+            number, low, high = [int(field) for field in fields]
+            calibration[number] = (signed_byte(low) / 16.0,
+                signed_byte(high) / 16.0)
+    finally:
+        f.close()
+    return calibration
+
+
+def calibrate(temp_c, correction):
+    """
+    Same correction as apply_calibration() in DS18B20_Suite_V3R1: a straight
+    line through the errors measured at 0 and 100 degrees C.
+    """
+    if not correction:
+        return temp_c
+    low, high = correction
+    return temp_c - (temp_c * (high - low) / 100.0 + low)
+
+
+class ConversionTable(object):
+    """
+    Calibrated temperatures for every raw value a sensor can report at its
+    resolution.  fahrenheit is rounded to 0.1 degree like the results file;
+    celsius and kelvin are not rounded.
+    """
+
+    def __init__(self, resolution = 12, correction = None):
+        self.resolution = resolution
+        self.correction = correction
+        self.mask = ~((1 << (12 - resolution)) - 1)
+
+        self.celsius = array('d')
+        self.fahrenheit = array('d')
+        self.kelvin = array('d')
+        for raw in range(raw_min, raw_max + 1):
+            temp_c, temp_f, temp_k = self.compute(raw)
+            self.celsius.append(temp_c)
+            self.fahrenheit.append(temp_f)
+            self.kelvin.append(temp_k)
+
+    def compute(self, raw):
+        temp_c = calibrate((raw & self.mask) / 16.0, self.correction)
+        return temp_c, round(1.8 * temp_c + 32.0, 1), temp_c + 273.15
+
+    def index(self, raw):
+        """
+        Position of a raw value in the tables, None if the DS18B20 could not
+        have reported it.
+        """
+        if raw < raw_min or raw > raw_max:
+            return None
+        return raw - raw_min
+
+    def to_celsius(self, raw):
+        i = self.index(raw)
+        if i is None:
+            return self.compute(raw)[0]
+        return self.celsius[i]
+
+    def to_fahrenheit(self, raw):
+        i = self.index(raw)
+        if i is None:
+            return self.compute(raw)[1]
+        return self.fahrenheit[i]
+
+    def to_kelvin(self, raw):
+        i = self.index(raw)
+        if i is None:
+            return self.compute(raw)[2]
+        return self.kelvin[i]
+
+
+table_cache = {}
+
+def conversion_table(resolution, correction = None):
+    """
+    The ConversionTable for this resolution and calibration, made the first
+    time it is asked for.
+    """
+    key = (resolution, correction)
+    if key not in table_cache:
+        table_cache[key] = ConversionTable(resolution, correction)
+    return table_cache[key]
+
+#---------------------------------------------------------------------
+
+# Test Code
+
+if __name__ == '__main__':
+
+    import os
+    import tempfile
+    import time
+
+    f = tempfile.NamedTemporaryFile(suffix = ".txt", delete = False)
+    f.write("# sensor  low  high\n")
+    f.write("3  4  250\n")    # reads 0.25 high at 0 C, 0.375 low at 100 C
+    f.close()
+    calibration = load_calibration(f.name)
+    os.remove(f.name)
+    print "calibration: ", calibration
+
+    plain = conversion_table(12)
+    calibrated = conversion_table(12, calibration[3])
+    coarse = conversion_table(9)
+    print "sensors sharing a table: ", conversion_table(12) is plain
+
+    for raw in [0, 4, 1600, 1606, -167]:
+        print "raw %5d: %7.4f C %5.1f F, calibrated %7.4f C, 9 bits %5.1f F" % (
+            raw, plain.to_celsius(raw), plain.to_fahrenheit(raw),
+            calibrated.to_celsius(raw), coarse.to_fahrenheit(raw))
+
+    raws = range(raw_min, raw_max + 1) * 20
+    start = time.time()
+    for raw in raws:
+        temp_f = plain.to_fahrenheit(raw)
+    table_time = time.time() - start
+    start = time.time()
+    for raw in raws:
+        temp_f = round(1.8 * (raw / 16.0) + 32.0, 1)
+    direct_time = time.time() - start
+    print "%d conversions: table %.1f ms, arithmetic %.1f ms" % (len(raws),
+        1000 * table_time, 1000 * direct_time)
@@ -0,0 +1,197 @@
+#!/usr/bin/python
+
+"""
+Keeps the runs, their sensors, every reading and every error in an SQLite
+database, for looking at later with a spreadsheet or any SQL tool.
+
+One database can hold any number of runs.  The readings table has an
+index on device number and time, so a sensor's readings over any stretch
+of time come straight out even after months of measurements.
+
+The database is in WAL mode: a measurement's rows are added to the end of
+the write ahead log instead of rewriting pages of the database, and other
+programs can read it while we write.  The rows of batch_cycles
+measurements are committed together in one transaction.
+
+    sqlite3 temperatures.db "SELECT timestamp, temperature_f FROM readings
+        WHERE device_number = 3 AND timestamp > strftime('%s', '2015-08-01')"
+"""
+
+import sqlite3
+import time
+from DS18B20Frames_V1R1 import decode_frames
+
+schema = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    title TEXT,
+    comment TEXT,
+    start INTEGER,          -- seconds since 1970
+    interval INTEGER,       -- seconds between measurements
+    base_file TEXT
+);
+CREATE TABLE IF NOT EXISTS sensors (
+    run INTEGER REFERENCES runs (id),
+    device_number INTEGER,
+    slot INTEGER,
+    name TEXT,
+    resolution INTEGER,
+    low_correction REAL,    -- calibration at 0 and 100 degrees C
+    high_correction REAL,
+    PRIMARY KEY (run, device_number)
+);
+CREATE TABLE IF NOT EXISTS readings (
+    timestamp INTEGER,
+    device_number INTEGER,
+    run INTEGER,
+    raw INTEGER,            -- scratchpad, sixteenths of a degree C
+    temperature_f REAL
+);
+CREATE INDEX IF NOT EXISTS readings_device_time
+    ON readings (device_number, timestamp);
+CREATE TABLE IF NOT EXISTS events (
+    timestamp INTEGER,
+    run INTEGER,
+    kind TEXT,              -- no data, wrong number of sensors,
+                            --   wrong sensor order, crc, missed
+    device_number INTEGER   -- NULL if not for one sensor
+);
+CREATE INDEX IF NOT EXISTS events_time ON events (timestamp);
+"""
+
+
+class TemperatureDatabase(object):
+    """
+    The database, open for one run.
+    """
+
+    def __init__(self, filename, batch_cycles = 1):
+        self.batch_cycles = batch_cycles
+        self.cycles = 0         # measurements not yet committed
+        self.run = None
+        self.registry = None
+
+        self.db = sqlite3.connect(filename)
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.execute("PRAGMA synchronous = NORMAL")
+        self.db.executescript(schema)
+        self.db.commit()
+
+    def start_run(self, title, comment, interval, start, base_file,
+            registry):
+        """
+        Adds the run and its sensors.
+        """
+        self.registry = registry
+        cursor = self.db.execute("INSERT INTO runs (title, comment, start, "
+            "interval, base_file) VALUES (?, ?, ?, ?, ?)", (title, comment,
+            start, interval, base_file))
+        self.run = cursor.lastrowid
+
+        rows = []
+        for sensor in registry:
+            correction = (None, None)
+            if sensor.conversion and sensor.conversion.correction:
+                correction = sensor.conversion.correction
+            rows.append((self.run, sensor.number, sensor.slot,
+                sensor.name.replace("\\:", ":"), sensor.resolution) +
+                tuple(correction))
+        self.db.executemany("INSERT INTO sensors VALUES (?, ?, ?, ?, ?, ?, ?)",
+            rows)
+        self.db.commit()
+        return self.run
+
+    def resume_run(self, run, registry):
+        """
+        Instead of start_run() when a run is resumed.
+        """
+        self.run = run
+        self.registry = registry
+
+    def readings(self, timestamp, frame_set, temp_f):
+        """
+        Adds the readings of one measurement: the frame set and the
+        temperature of each sensor, by slot.
+        """
+        rows = []
+        for frame in decode_frames(frame_set):
+            sensor = self.registry.lookup(frame[6])
+            rows.append((timestamp, frame[6], self.run, frame[1],
+                temp_f[sensor.slot]))
+        self.db.executemany("INSERT INTO readings VALUES (?, ?, ?, ?, ?)",
+            rows)
+
+    def event(self, kind, device_number = None, timestamp = None):
+        if timestamp is None:
+            timestamp = int(time.time())
+        self.db.execute("INSERT INTO events VALUES (?, ?, ?, ?)",
+            (timestamp, self.run, kind, device_number))
+
+    def end_cycle(self):
+        """
+        Called after each measurement.  Commits every batch_cycles
+        measurements.
+        """
+        self.cycles += 1
+        if self.cycles >= self.batch_cycles:
+            self.commit()
+
+    def commit(self):
+        self.db.commit()
+        self.cycles = 0
+
+    def temperatures(self, device_number, start, end):
+        """
+        (time, degrees F) of every reading of one sensor from start to
+        end, both included.
+        """
+        return self.db.execute("SELECT timestamp, temperature_f FROM "
+            "readings WHERE device_number = ? AND timestamp BETWEEN ? AND ? "
+            "ORDER BY timestamp", (device_number, start, end)).fetchall()
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+#---------------------------------------------------------------------
+
+# Test Code
+
+if __name__ == '__main__':
+
+    import os
+    import tempfile
+    from DS18B20Frames_V1R1 import build_frame
+    from SensorRegistry_V1R1 import SensorRegistry
+
+    frame_set = bytearray().join([build_frame(50, number, 20.0 +
+        0.1 * number, "Sensor %d" % number) for number in range(1, 51)])
+    registry = SensorRegistry().from_frames(frame_set)
+    temp_f = [68.0 + slot for slot in range(50)]
+
+    filename = os.path.join(tempfile.mkdtemp(), "temperatures.db")
+    database = TemperatureDatabase(filename)
+    start = 1439035200
+    print "run: ", database.start_run("Test", "", 60, start, "test",
+        registry)
+
+    # 3 days of one minute measurements, the way a long run adds them
+    cycles = 3 * 1440
+    begin = time.time()
+    for i in range(cycles):
+        database.readings(start + 60 * i, frame_set, temp_f)
+        if i % 1000 == 0:
+            database.event('crc', 7, start + 60 * i)
+        database.end_cycle()
+    print "50 sensors: %.2f ms per measurement" % (1000 *
+        (time.time() - begin) / cycles)
+
+    begin = time.time()
+    rows = database.temperatures(7, start + 86400, start + 2 * 86400 - 1)
+    print "one sensor, one day: %d readings in %.2f ms" % (len(rows),
+        1000 * (time.time() - begin))
+    print "journal mode: ", database.db.execute(
+        "PRAGMA journal_mode").fetchone()[0]
+    print "crc events: ", database.db.execute(
+        "SELECT count(*) FROM events WHERE kind = 'crc'").fetchone()[0]
+    database.close()
@@ -0,0 +1,294 @@
+#!/usr/bin/python
+
+"""
+Stores the temperatures of all the sensors in RRD files.
+
+With one RRD file per sensor every measurement is one update per sensor:
+each rewrites a file on the SD card and, with pyrrd's default backend,
+starts an rrdtool process.  With single_file each sensor is a data source
+in one RRD file, and every measurement is stored with one update no matter
+how many sensors there are.
+
+Each sensor's rrdfile and device are filled in, so the graph DEFs are made
+the same way either way.  In one file every sensor has the same device.
+
+Forking rrdtool for every update and graph is most of the Pi's work each
+measurement.  If the rrdtool Python module is installed (sudo apt-get
+install python-rrdtool) pyrrd calls librrd in the program itself instead.
+Without it the rrdtool program is run as before.  Pass rrd_backend to
+Graph() so the graphs are drawn the same way.
+
+Every measurement is kept in a LAST archive.  For long runs there are also
+rollups: 5 minute, hourly and daily averages, minimums and maximums, each
+sized to cover the whole run.  A month of one minute measurements is 43200
+points, far more than the 600 pixels of the graph, so the graph reads the
+coarsest archive that still has a point for every pixel instead.
+
+Writing the RRD files every measurement is a steady stream of small writes
+that wears the SD card and holds up the measurement when the card is slow.
+With a flush_interval the measurements wait in memory and are written to
+each RRD file in one update when the interval is up and at the end of the
+run.  The first measurement is written at once, so there is something to
+graph from the start.  The graphs are drawn from the RRD files, so a
+program draws them after each write, to written, the time of the newest
+measurement in the files.  If the program dies, the measurements still
+waiting in memory never reach the RRD files.  The results companion file
+has them, and a resumed run stores them again with reopen().  A
+measurement already in the RRD files is skipped.
+"""
+
+import os
+import time
+from pyrrd.rrd import DataSource, RRA, RRD
+
+try:
+    from pyrrd.backend import bindings as rrd_backend
+    backend_name = "rrdtool module, in this program"
+except ImportError:
+    from pyrrd.backend import external as rrd_backend
+    backend_name = "rrdtool program"
+
+# Archives besides the one holding every measurement: seconds per point and
+#   how the measurements in that time are consolidated.  A rollup is left
+#   out if it is no coarser than the one before it or if the run is too
+#   short to fill two of its points.
+rollups = [
+    (300, ['AVERAGE', 'MIN', 'MAX']),       # 5 minutes
+    (3600, ['AVERAGE', 'MIN', 'MAX']),      # hourly
+    (86400, ['AVERAGE', 'MIN', 'MAX']),     # daily
+]
+
+
+def archive_plan(step, rows, tiers = rollups):
+    """
+    (consolidation, steps, rows) for every archive of a run of rows
+    measurements step seconds apart.  The first holds every measurement.
+    """
+    plan = [('LAST', 1, rows)]
+    last_steps = 1
+    for seconds, cfs in tiers:
+        steps = int(round(float(seconds) / step))
+        if steps <= last_steps or rows < 2 * steps:
+            continue
+        last_steps = steps
+        for cf in cfs:
+            plan.append((cf, steps, rows / steps + 1))
+    return plan
+
+
+def store_entries(rrdfile, entries):
+    """
+    Writes entries, time:value:value..., to rrdfile in one update.  If
+    rrdtool refuses them because some are already in the file, stores the
+    rest one by one.  Returns how many were stored.
+    """
+    count = len(entries)
+    try:
+        # a copy, the rrdtool module puts the file name in front of the list
+        rrd_backend.update(rrdfile, list(entries))
+        return count
+    except Exception:
+        stored = 0
+        for entry in entries:
+            try:
+                rrd_backend.update(rrdfile, [entry])
+                stored += 1
+            except Exception:
+                pass    # "illegal attempt to update using time ..."
+        return stored
+
+
+class TemperatureStore(object):
+    """
+    The RRD files for all the sensors in a SensorRegistry.
+    """
+
+    def __init__(self, filename, registry, step, rows, start,
+            single_file = True, flush_interval = 0):
+        self.registry = registry
+        self.single_file = single_file
+        self.flush_interval = flush_interval  # seconds, 0 writes every time
+        self.last_flush = 0   # so the first measurement is written at once
+        self.pending = 0      # measurements not yet in the RRD files
+        self.latest = None    # time of the newest measurement
+        self.written = None   # time of the newest one in the RRD files
+        self.duplicates = 0   # measurements the RRD files already had
+        self.step = step
+        self.plan = archive_plan(step, rows)
+        self.devices = []     # one RRD, or one per sensor in slot order
+
+        if single_file:
+            self.devices.append(self.make_rrd(filename + '_sensors.rrd',
+                list(registry), step, rows, start))
+            for sensor in registry:
+                sensor.rrdfile = self.devices[0].filename
+                sensor.device = self.devices[0]
+        else:
+            for sensor in registry:
+                sensor.rrdfile = (filename + '_sensor' + str(sensor.slot + 1)
+                    + '.rrd')
+                sensor.device = self.make_rrd(sensor.rrdfile, [sensor],
+                    step, rows, start)
+                self.devices.append(sensor.device)
+
+    def make_rrd(self, rrdfile, sensors, step, rows, start):
+        dataSources = []
+        for sensor in sensors:
+            dataSources.append(DataSource(dsName=sensor.ds_name,
+                dsType='GAUGE', heartbeat=int(1.5 * step)))
+
+        roundRobinArchives = []
+        for cf, steps, cf_rows in self.plan:
+            roundRobinArchives.append(RRA(cf=cf, xff=0.5, steps=steps,
+                rows=cf_rows))
+
+        return RRD(rrdfile, step=step, ds=dataSources,
+            rra=roundRobinArchives, start=start, backend=rrd_backend)
+
+    def files(self):
+        return [device.filename for device in self.devices]
+
+    def archive(self, start, end, width = 600):
+        """
+        Consolidation and seconds per point of the coarsest archive that
+        still has a point for every pixel of a graph width pixels wide from
+        start to end.  The seconds are None for the archive of every
+        measurement, which rrdtool picks by itself.
+        """
+        per_pixel = float(end - start) / width
+        cf, seconds = 'LAST', None
+        for plan_cf, steps, rows in self.plan[1:]:
+            if plan_cf == 'AVERAGE' and steps * self.step <= per_pixel:
+                cf, seconds = plan_cf, steps * self.step
+        return cf, seconds
+
+    def fetch(self, sensor, start, end, width = 600):
+        """
+        A sensor's temperatures from start to end, as a list of (time,
+        value), from the same archive a graph width pixels wide would use.
+        """
+        cf, seconds = self.archive(start, end, width)
+        data = sensor.device.fetch(cf = cf, resolution = seconds,
+            start = start, end = end)
+        return data[sensor.ds_name]
+
+    def create(self):
+        for device in self.devices:
+            device.create(debug=False)
+
+    def reopen(self, rows = ()):
+        """
+        Instead of create() when a run is resumed.  The RRD files are kept
+        and only any that are missing are made.  rows, (time, temperature
+        of each sensor by slot), are the measurements the RRD files may
+        have missed when the run stopped.  They are written, less any the
+        files already have.  Returns how many were stored.
+        """
+        for device in self.devices:
+            if not os.path.exists(device.filename):
+                device.create(debug=False)
+        if not rows:
+            return 0
+        duplicates = self.duplicates
+        self.last_flush = time.time()   # all of them in one update
+        for timestamp, temp_f in rows:
+            self.update(timestamp, temp_f)
+        self.close()
+        return len(rows) - (self.duplicates - duplicates) / len(self.devices)
+
+    def update(self, timestamp, temp_f):
+        """
+        Stores one measurement.  temp_f is the temperature of each sensor,
+        by slot, None for unknown.  Returns True if the measurements were
+        written to the RRD files, False if they are waiting in memory.
+        """
+        values = ['U' if value is None else str(value) for value in temp_f]
+        if self.single_file:
+            batches = [(self.devices[0], [values[sensor.slot]
+                for sensor in self.registry])]
+        else:
+            batches = [(sensor.device, [values[sensor.slot]])
+                for sensor in self.registry]
+
+        for device, values in batches:
+            device.bufferValue(timestamp, *values)
+        self.pending += 1
+        self.latest = timestamp
+
+        if time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+            return True
+        return False
+
+    def flush(self):
+        """
+        Writes the measurements waiting in memory to the RRD files, one
+        update per file.  Any the files already have are left out.
+        """
+        for device in self.devices:
+            try:
+                device.update(debug = False)
+            except Exception:
+                entries = [":".join([str(field) for field in value])
+                    for value in device.values]
+                device.values = []
+                self.duplicates += len(entries) - store_entries(
+                    device.filename, entries)
+        self.pending = 0
+        self.last_flush = time.time()
+        self.written = self.latest
+
+    def close(self):
+        """
+        Writes what is waiting.  Call at the end of the run.
+        """
+        if self.pending:
+            self.flush()
+
+#---------------------------------------------------------------------
+
+# Test Code
+
+if __name__ == '__main__':
+
+    import tempfile
+    from SensorRegistry_V1R1 import SensorRegistry
+
+    registry = SensorRegistry()
+    for number in range(1, 21):
+        registry.add(number, "Sensor %d" % number, 12)
+
+    print "storing with the", backend_name
+    for step, rows in [(60, 60), (60, 43200), (600, 1000)]:
+        print "%d measurements every %d seconds:" % (rows, step), [
+            "%s %d x %d" % archive for archive in archive_plan(step, rows)]
+    folder = tempfile.mkdtemp()
+    start = int(time.time() / 60) * 60
+    for single_file in [False, True]:
+        store = TemperatureStore(os.path.join(folder, "test"), registry, 60,
+            100, start, single_file)
+        store.create()
+        begin = time.time()
+        for i in range(1, 11):
+            store.update(start + 60 * i, [20.0 + slot for slot in
+                range(len(registry))])
+        print "%d files, 10 updates: %.1f ms" % (len(store.files()),
+            1000 * (time.time() - begin))
+
+    store = TemperatureStore(os.path.join(folder, "month"), registry, 60,
+        43200, start)
+    for days in [0.25, 2, 30]:
+        print "graph of %s days reads" % days, store.archive(start,
+            start + int(days * 86400))
+
+    # Measurements wait an hour, all but the first
+    store = TemperatureStore(os.path.join(folder, "cached"), registry, 60,
+        100, start, True, 3600)
+    store.create()
+    written = [store.update(start + 60 * i, [20.0 + slot for slot in
+        range(len(registry))]) for i in range(1, 11)]
+    print "written at once: %d, waiting: %d, newest written: %d" % (
+        written.count(True), store.pending, store.written - start)
+    store.close()
+    print "after close, waiting: %d, newest written: %d" % (store.pending,
+        store.written - start)
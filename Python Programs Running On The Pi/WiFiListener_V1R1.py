@@ -0,0 +1,277 @@
+#!/usr/bin/python
+
+"""
+Persistent listener for the ESP8266s in the temperature enclosures.
+
+The ESP8266 is the client.  Every time it has collected a complete set of
+frames from the ATmega328P it tries to connect to the Pi on port 50007 and
+push the data.  If nobody is listening the data is simply lost.
+
+Instead of opening a new socket for every measurement, the listener thread
+keeps the server socket open for the whole run and accepts every push as it
+arrives.  One asyncore event loop serves all the connections, so any number
+of enclosures can push at the same time.  The most recent frame set that
+passes validation is kept in memory for each enclosure, keyed by the IP
+address of its ESP8266.  The measurement loop reads from that cache instead
+of waiting for the ESP8266.
+"""
+
+import asyncore
+import socket
+import threading
+import time
+from DS18B20Frames_V1R1 import FrameAssembler, binary_offer
+
+
+class PushHandler(asyncore.dispatcher):
+    """
+    One connection from an ESP8266.  Offers binary framing if the listener
+    wants it, then feeds whatever arrives to a FrameAssembler and hands the
+    frame set to the listener as soon as it is complete, or when the ESP8266
+    closes the connection.
+    """
+
+    def __init__(self, sock, addr, listener):
+        asyncore.dispatcher.__init__(self, sock, map = listener.socket_map)
+        self.addr = addr
+        self.listener = listener
+        self.opened = time.time()
+        self.assembler = FrameAssembler(listener.frame_length)
+        self.finished = False
+        self.offer = listener.offer_binary and binary_offer or ""
+
+    def handle_read(self):
+        data = self.recv(4096)
+        if data and (self.assembler.feed(data) or self.assembler.error):
+            self.handle_close()  # no need to wait for the ESP8266 to close
+
+    def handle_close(self):
+        self.close()
+        if not self.finished:
+            self.finished = True
+            self.assembler.finish()
+            self.listener.store(self.addr[0], self.assembler)
+
+    def handle_error(self):
+        self.finished = True   # throw away whatever we got
+        self.listener.rejected += 1
+        self.close()
+
+    def handle_write(self):
+        sent = self.send(self.offer)
+        self.offer = self.offer[sent:]
+
+    def writable(self):
+        return bool(self.offer)
+
+
+class PushServer(asyncore.dispatcher):
+    """
+    The server socket.  Hands every new connection to a PushHandler.
+    """
+
+    def __init__(self, listener):
+        asyncore.dispatcher.__init__(self, map = listener.socket_map)
+        self.listener = listener
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM) #IPv4 TCP/IP
+        self.set_reuse_addr()
+        self.bind((listener.host, listener.port))
+        self.listen(64)
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            conn, addr = pair
+            self.listener.pushes += 1
+            PushHandler(conn, addr, self.listener)
+
+    def handle_error(self):
+        pass   # a failed accept must not stop the server
+
+
+class WiFiListener(threading.Thread):
+    """
+    Background thread that accepts ESP8266 pushes and caches the most
+    recent good frame set from each enclosure.
+
+    Call start() once at the beginning of the program.  Use latest() to get
+    the cached frame set and wait_for_new() to wait for a push newer than one
+    already seen.  Both take the enclosure, the IP address of its ESP8266.
+    If enclosure is None they use whichever enclosure pushed last, which is
+    what a single enclosure program wants.
+    """
+
+    def __init__(self, host = '', port = 50007, frame_length = 20,
+            conn_timeout = 10.0, offer_binary = True):
+        threading.Thread.__init__(self)
+        self.daemon = True    # do not keep the program alive on exit
+
+        self.host = host
+        self.port = port
+        self.frame_length = frame_length
+        self.conn_timeout = conn_timeout  # seconds an ESP8266 may take
+        self.offer_binary = offer_binary  # ask ESP8266s for binary frames
+
+        self.socket_map = {}  # asyncore channels belonging to this thread
+        self.condition = threading.Condition()
+        self.cache = {}       # enclosure -> [sequence, sensors, received,
+                              #               frame_set]
+        self.sequence = 0     # incremented for every good push
+        self.last_enclosure = None
+
+        self.pushes = 0       # every connection accepted
+        self.binary_pushes = 0  # good pushes that came in binary
+        self.rejected = 0     # pushes that failed validation
+        self.running = True
+
+    def run(self):
+        """
+        Opens the server socket once and runs the event loop until stop()
+        is called.  Every second connections that have been open too long
+        are dropped.
+        """
+        server = PushServer(self)
+        try:
+            while self.running:
+                asyncore.loop(timeout = 1.0, map = self.socket_map, count = 1)
+                self.expire()
+        finally:
+            for channel in self.socket_map.values():
+                channel.close()
+
+    def expire(self):
+        now = time.time()
+        for channel in self.socket_map.values():
+            if (isinstance(channel, PushHandler) and
+                    now - channel.opened > self.conn_timeout):
+                channel.handle_error()
+
+    def store(self, enclosure, assembler):
+        """
+        If the push from the ESP8266 put together a complete frame set,
+        makes it the cached frame set for that enclosure.  The frame set is
+        a bytearray, one element per byte.
+
+        Every frame must carry the number of sensors in byte 0 and there
+        must be that many frames.  FrameAssembler checks this.
+        """
+        if not assembler.complete():
+            self.rejected += 1
+            return False
+        recv_data = assembler.frame_set()
+        sensors = assembler.sensors
+        if assembler.binary:
+            self.binary_pushes += 1
+
+        self.condition.acquire()
+        try:
+            self.sequence += 1
+            self.cache[enclosure] = [self.sequence, sensors, time.time(),
+                recv_data]
+            self.last_enclosure = enclosure
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+        return True
+
+    def enclosures(self):
+        """
+        Returns the enclosures that have pushed good data, in address order.
+        """
+        self.condition.acquire()
+        try:
+            return sorted(self.cache.keys())
+        finally:
+            self.condition.release()
+
+    def _entry(self, enclosure):
+        if enclosure is None:
+            enclosure = self.last_enclosure
+        return self.cache.get(enclosure, [0, 0, 0, []])
+
+    def latest(self, max_age = None, enclosure = None):
+        """
+        Returns (sequence, sensors, frame_set) for the cached frame set.
+        If there is nothing cached, or the cache is older than max_age
+        seconds, returns (sequence, 0, []).
+        """
+        self.condition.acquire()
+        try:
+            sequence, sensors, received, frame_set = self._entry(enclosure)
+            if not sequence or (max_age is not None and
+                    time.time() - received > max_age):
+                return sequence, 0, []
+            return sequence, sensors, frame_set
+        finally:
+            self.condition.release()
+
+    def wait_for_new(self, last_sequence, timeout = 10.0, enclosure = None):
+        """
+        Waits up to timeout seconds for a frame set newer than
+        last_sequence.  Returns the same as latest().  Returns 0 sensors if
+        nothing new arrived in time.
+        """
+        deadline = time.time() + timeout
+        self.condition.acquire()
+        try:
+            while self._entry(enclosure)[0] <= last_sequence:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return self._entry(enclosure)[0], 0, []
+                self.condition.wait(remaining)
+            sequence, sensors, received, frame_set = self._entry(enclosure)
+            return sequence, sensors, frame_set
+        finally:
+            self.condition.release()
+
+    def stop(self):
+        self.running = False
+
+#---------------------------------------------------------------------
+
+# Test Code
+
+if __name__ == '__main__':
+
+    from DS18B20Frames_V1R1 import binary_header, binary_magic
+
+    listener = WiFiListener(port = 50017)
+    listener.start()
+    time.sleep(0.5)
+
+    # Stand in for several ESP8266s at once.  Each enclosure connects from
+    # its own loopback address and has enclosure + 1 sensors.
+    clients = []
+    for enclosure in range(1, 9):
+        sensors = enclosure + 1
+        frames = ""
+        raw = bytearray()
+        for number in range(sensors):
+            frame = [sensors, 80, 1, 75, 70, 127]
+            frame += [ord(c) for c in "Test Sensor\n"] + [number, 0]
+            raw += bytearray(frame)
+            for byte in frame:
+                frames += str(byte) + ","
+        if enclosure % 2:   # odd enclosures have the binary firmware
+            frames = binary_header.pack(binary_magic, len(raw)) + str(raw)
+
+        c = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        c.bind(('127.0.0.%d' % enclosure, 0))
+        c.connect(('127.0.0.1', 50017))
+        clients.append((c, frames))
+
+    # send half of everything first so all connections are open together
+    for c, frames in clients:
+        c.sendall(frames[:len(frames) / 2])
+    for c, frames in clients:
+        c.sendall(frames[len(frames) / 2:])
+        c.close()
+
+    time.sleep(1.0)
+    for enclosure in listener.enclosures():
+        sequence, sensors, frame_set = listener.latest(enclosure = enclosure)
+        print "enclosure %s: %d sensors" % (enclosure, sensors)
+    print "pushes: %d, binary: %d, rejected: %d" % (listener.pushes,
+        listener.binary_pushes, listener.rejected)
+    listener.stop()
+    listener.join()
@@ -6,7 +6,12 @@ We synchronize with the data from the Sensor board and decode the data from one
 sensor to find out how many sensors are connected to the temperature box.  If there
 is more than one sensor, the data from the other sensors are then collected.  
 
-All the data is put into one string.
+All the data is put into one string, and the same bytes into one array.
+
+When we connect, a Pi that understands binary frames sends us a "B".  In that
+case we send a 4 byte header, "DS" and the length of the data (high byte
+first), followed by the raw bytes.  Otherwise we send the string, every byte
+in decimal followed by a comma.
 
 We check to see if the Pi wants data by listening to see if the Pi, which acts as a 
 server is on-line.  If not, the recently acquired data is simply lost.
@@ -34,6 +39,9 @@ volatile  boolean found_transistion;
 const int bit_time = 833;  //833 usec. = 1200 baud (600 for data)
 const int frame_len = 20;
 byte frame[frame_len];  // Data for one sensor from transmitting device
+const int max_sensors = 50;  // Most the ATmega328P EEPROM can hold
+byte xmit_frames[max_sensors * frame_len];  // All the data as raw bytes
+const int offer_wait = 200;  // msec. to wait for the Pi to offer binary
 
 /*-----------------------------------interrupt service routine-------------------------------*/
 void findTransistion(){
@@ -150,14 +158,31 @@ boolean calculateCRC_byte(byte inByte[], int num_bytes){
 }
 
 /*-------------------------------transmit_data()-------------------------------*/
-boolean transmit_data(String dataToPi){
+boolean transmit_data(String dataToPi, int xmit_length){
 
   String dataFromPi;
   boolean success = false;
+  unsigned long time;
+  byte header[4];
       
   //Connect to server on Pi and send all data
   if(client.connect(host, httpPort)){
-      client.print(dataToPi); 
+      time = millis();
+      while (!client.available() && (millis() - time < offer_wait)){
+        delay(1);
+      }
+      
+      if (client.available() && (client.read() == 'B')){  //Pi wants binary
+        header[0] = 'D';
+        header[1] = 'S';
+        header[2] = xmit_length >> 8;
+        header[3] = xmit_length & 0xFF;
+        client.write(header, 4);
+        client.write(xmit_frames, xmit_length);
+      }
+      else{
+        client.print(dataToPi); 
+      }
       success = true;
   }
         
@@ -197,12 +222,14 @@ void loop() {
   synchronize();  //find synchronization
   manchester_data();  //find one frame worth of data, get frame[]
 
-  if (!calculateCRC_byte(frame, frame_len)){
+  number_of_sensors = 0;
+  if (!calculateCRC_byte(frame, frame_len) && (frame[0] <= max_sensors)){
     number_of_sensors = frame[0];
 
     //char xmit_data[number_of_sensors * frame_len];  //define xmit_data here
     for (j = 0; j < frame_len; j++){
       //xmit_data[j] = frame[j];
+      xmit_frames[j] = frame[j];
       dataToXmit.concat(frame[j]);
       dataToXmit.concat(',');
     }
@@ -217,6 +244,7 @@ void loop() {
       else{
         for (j = 0; j < frame_len; j++){
           //xmit_data[frame_len * i + j] = frame[j];
+          xmit_frames[frame_len * i + j] = frame[j];
           dataToXmit.concat(frame[j]);          
           dataToXmit.concat(',');
         }
@@ -226,8 +254,8 @@ void loop() {
     
   //Serial.println(dataToXmit);
 
-  if (CRCs_good){
-    successful = transmit_data(dataToXmit);
+  if (CRCs_good && number_of_sensors){
+    successful = transmit_data(dataToXmit, number_of_sensors * frame_len);
   }
   
   if (successful){